@@ -0,0 +1,23 @@
+# Kinovea .kva parsing and processing helpers used by "Analyze - Extract Tracking From KVA.py".
+#
+# The stages can be called from other code:
+#
+#   import kvaparser
+#   Kva = kvaparser.parse_kva('session.kva', progress=False)
+#   Tracking, OutPaths = kvaparser.process_file('session.kva', {'cutoff': 'auto', 'formats': ['npy']})
+#
+# Importing the package only loads numpy. pandas, scipy and tqdm are imported by the stages which use them, so
+# read_header, for instance, needs neither scipy nor pandas' data processing, and tkinter is never imported.
+
+from kvaparser.parse import KvaData, TrackData, parse_kva, read_header
+from kvaparser.align import align_tracks
+from kvaparser.calibration import normalize, calibrate, denormalize
+from kvaparser.filtering import filter_markers, auto_cutoff
+from kvaparser.kinematics import pair_kinematics
+from kvaparser.output import write_output, read_tracking
+from kvaparser.metrics import RunMetrics
+from kvaparser.pipeline import Tracking, load_config, process_kva, process_file
+
+__all__ = ['KvaData', 'TrackData', 'parse_kva', 'read_header', 'align_tracks', 'normalize', 'calibrate',
+           'denormalize', 'filter_markers', 'auto_cutoff', 'pair_kinematics', 'write_output', 'read_tracking',
+           'Tracking', 'load_config', 'process_kva', 'process_file', 'RunMetrics']
@@ -0,0 +1,110 @@
+# Alignment of the parsed tracks on a common frame grid.
+#
+# Every point is mapped to an integer frame index and written straight into one preallocated (frames x channels)
+# matrix. The frame comes from the video timestamp of the point, (Tick - FirstTimeStamp) / TimeStampsPerFrame, when the
+# file has them, else from its time, round(Time * FPS). Kinovea times only have hundredths of a second by default, so
+# above 100 fps they cannot tell all the frames apart; a track with two points on the same frame is an error rather
+# than being silently merged. The timestamps are only used if they agree with the times of all the tracks, up to the
+# resolution of the times and an offset common to all the tracks (a time origin moved in Kinovea shifts all the times),
+# so a misread timestamp cannot shift a marker against the others. The time base is the one of the first marker: points of the other markers falling on
+# frames the first marker does not have are dropped, frames they miss are left as NaN. The frames are the index of the
+# table (see MarkerTable.to_frame and frame_index), its Time column keeps the times of the file.
+
+from dataclasses import dataclass
+
+import numpy as np
+
+
+# Resolution of the Kinovea times, s
+TIME_RESOLUTION = 0.01
+
+
+@dataclass
+class MarkerTable:
+    Time: np.ndarray
+    Frame: np.ndarray
+    Data: np.ndarray # frames x (2 * markers), X and Y of each marker in turn
+    Columns: list
+    FrameSource: str = 'times' # or 'timestamps'
+
+    def to_frame(self):
+        import pandas as pd
+        MarkerDataAll = pd.DataFrame(self.Data, columns=self.Columns, index=pd.Index(self.Frame, name='Frame'))
+        MarkerDataAll.insert(0, 'Time', self.Time)
+        return MarkerDataAll
+
+
+def time_to_frame(Time, FPS):
+    return np.rint(np.asarray(Time) * FPS).astype(np.int64)
+
+
+def tick_to_frame(Tick, FirstTimeStamp, TimeStampsPerFrame):
+    return np.rint((np.asarray(Tick) - FirstTimeStamp) / TimeStampsPerFrame).astype(np.int64)
+
+
+def frame_index(MarkerDataAll, FPS):
+    """Frame of each row of a Time, X, Y... table: its index if it holds the frames (see MarkerTable.to_frame), else
+    the frame of its time."""
+    if MarkerDataAll.index.name == 'Frame':
+        return MarkerDataAll.index.to_numpy(dtype=np.int64)
+    return time_to_frame(MarkerDataAll['Time'].to_numpy(dtype=float), FPS)
+
+
+def track_frames(Tracks, FPS, FirstTimeStamp=0, TimeStampsPerFrame=0):
+    """Frames of the points of each track, from their timestamps if all have one and they agree with the times,
+    else from the times. Returns the frames of each track and 'timestamps' or 'times'.
+
+    Raises ValueError if two points of a track fall on the same frame.
+    """
+    Frames = [time_to_frame(Track.Time, FPS) for Track in Tracks]
+    Source = 'times'
+    if TimeStampsPerFrame > 0 and all(Track.Tick is not None for Track in Tracks):
+        TickFrames = [tick_to_frame(Track.Tick, FirstTimeStamp, TimeStampsPerFrame) for Track in Tracks]
+        Diff = np.concatenate([Ticks - Times for Ticks, Times in zip(TickFrames, Frames)])
+        # A frame for the rounding of each, and the frames within the resolution of the times
+        if len(Diff) == 0 or np.abs(Diff - np.median(Diff)).max() <= 1 + TIME_RESOLUTION / 2 * FPS:
+            Frames, Source = TickFrames, 'timestamps'
+    for Track, Frame in zip(Tracks, Frames):
+        nRepeated = len(Frame) - len(np.unique(Frame))
+        if nRepeated:
+            raise ValueError(f'{nRepeated} points of {Track.Name} fall on a frame already taken by another of its '
+                             f'points (frames from the {Source} at {FPS:g} fps)')
+    return Frames, Source
+
+
+def align_tracks(Tracks, FPS, FirstTimeStamp=0, TimeStampsPerFrame=0):
+    """Fill a frames x channels matrix with the X and Y coordinates of all the tracks, in a single pass per track.
+
+    The frames come from the timestamps of the points if TimeStampsPerFrame is given, all the points have one and
+    they agree with the times, else from the times (see track_frames). Raises ValueError if two points of a track fall
+    on the same frame.
+    """
+    if FPS <= 0:
+        raise ValueError(f'Cannot align tracks on frames with a frame rate of {FPS} fps')
+    Columns = [Track.Name + Axis for Track in Tracks for Axis in ('_X', '_Y')]
+    if len(Tracks) == 0:
+        return MarkerTable(np.zeros(0), np.zeros(0, dtype=np.int64), np.zeros((0, 0)), Columns)
+    Frames, Source = track_frames(Tracks, FPS, FirstTimeStamp, TimeStampsPerFrame)
+
+    Ref = Tracks[0]
+    Frame = Frames[0]
+    Data = np.full((len(Frame), len(Columns)), np.nan)
+    Data[:, 0] = Ref.X
+    Data[:, 1] = Ref.Y
+    if len(Frame) == 0:
+        return MarkerTable(Ref.Time, Frame, Data, Columns, Source)
+
+    # Frame -> row lookup over the span of the first marker, -1 where it has no point
+    F0 = Frame.min()
+    Row = np.full(Frame.max() - F0 + 1, -1, dtype=np.int64)
+    Row[Frame - F0] = np.arange(len(Frame))
+
+    for itrack, Track in enumerate(Tracks[1:], start=1):
+        Idx = Frames[itrack] - F0
+        Valid = (Idx >= 0) & (Idx < len(Row))
+        Rows = Row[Idx[Valid]]
+        Matched = Rows >= 0
+        Rows = Rows[Matched]
+        Data[Rows, 2 * itrack] = Track.X[Valid][Matched]
+        Data[Rows, 2 * itrack + 1] = Track.Y[Valid][Matched]
+    return MarkerTable(Ref.Time, Frame, Data, Columns, Source)
@@ -0,0 +1,149 @@
+# Headless batch processing of many .kva files on a process pool.
+#
+#   python -m kvaparser.batch SESSIONS_DIR "other/**/*.kva" --config batch.json --workers 8 --report summary.json
+#
+# Each file is processed with the config file (see kvaparser.pipeline for its keys) updated with its own sidecar
+# <name>.kva.json, if present. The parse cache is off unless the config turns it on (or --cache): a one-shot batch
+# would only pay for hashing and storing every file. A failing file is reported and does not stop the others. The report holds the metrics
+# of each stage of each file (see kvaparser.metrics), also of the stages done before a file failed.
+# A worker process killed while processing a file (e.g. by the out-of-memory killer) breaks the whole pool: the files
+# left unfinished go to a fresh pool, and when a pool breaks before finishing any file, the first of them runs alone so
+# that a file killing its worker is reported as failed instead of stopping the batch.
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from kvaparser.metrics import RunMetrics
+from kvaparser.output import FORMATS
+from kvaparser.pipeline import DEFAULT_CONFIG, load_config, process_file
+
+BATCH_DEFAULTS = dict(DEFAULT_CONFIG, cache=False)
+
+
+def find_kva_files(Paths):
+    """Expand directories (recursively) and glob patterns into a sorted list of unique .kva files."""
+    Files = []
+    for Path in Paths:
+        if os.path.isdir(Path):
+            Files += glob.glob(os.path.join(Path, '**', '*.kva'), recursive=True)
+        else:
+            Files += glob.glob(Path, recursive=True)
+    return sorted(set(os.path.abspath(File) for File in Files))
+
+
+def _process_one(FilePath, ConfigPath, Overrides):
+    tic = time.perf_counter()
+    Result = {'file': FilePath, 'status': 'ok', 'output': None, 'error': None}
+    Metrics = RunMetrics(FilePath)
+    try:
+        Config = load_config(ConfigPath, FilePath, BATCH_DEFAULTS)
+        Config.update(Overrides)
+        Tracking, OutPaths = process_file(FilePath, Config, Metrics=Metrics)
+        Result.update(output=OutPaths, markers=len(Tracking.OldCols) // 2, frames=len(Tracking.MarkerDataAllF),
+                      continuous=bool(Tracking.Continuous), segments=len(Tracking.Segments),
+                      short_segments=sum(1 for Seg in Tracking.Segments if Seg.Short))
+    except Exception as err:
+        Result.update(status='error', error=f'{type(err).__name__}: {err}', traceback=traceback.format_exc())
+    Result['seconds'] = round(time.perf_counter() - tic, 3)
+    Summary = Metrics.to_dict()
+    for Key in ('rss_start_mb', 'peak_rss_mb', 'process_peak_rss_mb'):
+        Result[Key] = Summary[Key]
+    Result['stages'] = Metrics.Stages
+    return Result
+
+
+def _run_pool(Files, Workers, ConfigPath, Overrides, record):
+    # Process Files on a fresh pool, passing each result to record. Returns the files left unfinished because a worker
+    # died, the one it was processing among them.
+    Unfinished = []
+    with ProcessPoolExecutor(max_workers=Workers) as pool:
+        Futures = {pool.submit(_process_one, File, ConfigPath, Overrides): File for File in Files}
+        for Future in as_completed(Futures):
+            try:
+                record(Future.result())
+            except BrokenProcessPool:
+                Unfinished.append(Futures[Future])
+    return sorted(Unfinished)
+
+
+def run_batch(Paths, ConfigPath=None, Workers=None, OutDir=None, Formats=None, progress=True, Cache=None):
+    """Process all the .kva files found in Paths in parallel. Returns one result dict per file, in file order.
+
+    Cache turns the parse cache on or off for all the files, else it is as in the config, off by default.
+    """
+    Files = find_kva_files(Paths)
+    Overrides = {'output_dir': OutDir} if OutDir else {}
+    if Formats:
+        Overrides['formats'] = Formats
+    if Cache is not None:
+        Overrides['cache'] = Cache
+    if OutDir:
+        os.makedirs(OutDir, exist_ok=True)
+    Results = {}
+
+    def record(Result):
+        Results[Result['file']] = Result
+        if progress:
+            print(f'[{len(Results)}/{len(Files)}] {Result["status"]:5s} {Result["file"]}'
+                  + (f' - {Result["error"]}' if Result['error'] else ''))
+
+    Pending = Files
+    while Pending:
+        Unfinished = _run_pool(Pending, Workers, ConfigPath, Overrides, record)
+        if Unfinished and len(Unfinished) == len(Pending):
+            # No file finished: run the first one alone, a worker dying now was killed by this file
+            tic = time.perf_counter()
+            if _run_pool(Unfinished[:1], 1, ConfigPath, Overrides, record):
+                record({'file': Unfinished[0], 'status': 'error', 'output': None,
+                        'error': 'BrokenProcessPool: the worker process died while processing this file '
+                                 '(killed, e.g. out of memory)',
+                        'seconds': round(time.perf_counter() - tic, 3), 'rss_start_mb': None, 'peak_rss_mb': None,
+                        'process_peak_rss_mb': None, 'stages': []})
+            Unfinished = Unfinished[1:]
+        Pending = Unfinished
+    return [Results[File] for File in Files]
+
+
+def summarize(Results):
+    Failed = [Result for Result in Results if Result['status'] != 'ok']
+    Summary = {'files': len(Results), 'ok': len(Results) - len(Failed), 'failed': len(Failed),
+               'not_continuous': sum(1 for Result in Results if Result.get('continuous') is False),
+               'seconds': round(sum(Result['seconds'] for Result in Results), 3),
+               'results': Results}
+    return Summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extract tracking from many .kva files without prompts.')
+    parser.add_argument('paths', nargs='+', help='.kva files, directories (searched recursively) or glob patterns')
+    parser.add_argument('--config', help='JSON file with the answers to the interactive prompts')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes, all cores by default')
+    parser.add_argument('--output-dir', help='folder for the _Tracking outputs, next to each .kva by default')
+    parser.add_argument('--format', nargs='+', choices=FORMATS, help='output formats, csv by default (or from config)')
+    parser.add_argument('--report', help='write the summary report as JSON to this file')
+    parser.add_argument('--cache', action='store_true', default=None,
+                        help='keep parse results in the parse cache, e.g. to re-run the batch with another config')
+    args = parser.parse_args(argv)
+
+    Summary = summarize(run_batch(args.paths, args.config, args.workers, args.output_dir, args.format,
+                                  Cache=args.cache))
+    print(f'\n{Summary["files"]} files: {Summary["ok"]} ok, {Summary["failed"]} failed, '
+          f'{Summary["not_continuous"]} with skipped frames')
+    for Result in Summary['results']:
+        if Result['status'] != 'ok':
+            print(f'  {Result["file"]}: {Result["error"]}')
+    if args.report:
+        with open(args.report, 'w') as file:
+            json.dump(Summary, file, indent=2)
+    return 1 if Summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# Benchmark of each stage of the processing on a synthetic .kva file (see kvaparser.synth).
+#
+#   python -m kvaparser.bench --markers 6 --frames 100000 --fps 60 --colon --gaps 5 --save baseline.json
+#   python -m kvaparser.bench --markers 6 --frames 100000 --fps 60 --colon --gaps 5 --compare baseline.json
+#
+# Each stage is timed over a few repeats (the best one is kept) and reported with its throughput in track points/s
+# (and MB/s of .kva for the parsing). Peak memory of each stage is measured in a separate pass with tracemalloc, which
+# slows Python down too much to be used while timing. With --compare, a stage slower than the saved baseline by more
+# than the tolerance is reported as a regression and the exit code is 1.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from kvaparser.synth import write_kva
+from kvaparser.parse import parse_kva
+from kvaparser.align import align_tracks
+from kvaparser.calibration import normalize, calibrate, denormalize
+from kvaparser.filtering import filter_markers
+from kvaparser.output import rename_markers, write_csv, write_npy
+from kvaparser.pipeline import Tracking
+
+STAGES = ['parse', 'align', 'normalize', 'calibrate', 'filter', 'rename', 'write_csv', 'write_npy']
+
+
+def run_stages(FilePath, OutBase, fcut=5, clock=None, parse_workers=None):
+    """Run the whole processing of a file stage by stage, with default answers to the prompts.
+
+    clock(stage) is a context manager wrapped around each stage.
+    """
+    with clock('parse'):
+        Kva = parse_kva(FilePath, progress=False, workers=parse_workers)
+    with clock('align'):
+        MarkerDataAll = align_tracks(Kva.Tracks, Kva.FPS, Kva.FirstTimeStamp, Kva.TimeStampsPerFrame).to_frame()
+    with clock('normalize'):
+        MarkerDataAll, LineDataAll = normalize(MarkerDataAll, Kva.LineDataAll, Kva.ImX, Kva.ImY)
+    with clock('calibrate'):
+        MarkerDataAll, LineDataAll, LineCal, Units = calibrate(MarkerDataAll, LineDataAll, Kva.MarkerNames,
+                                                               Kva.CalPx2Unit, Kva.Units, AllowGlobalCalibration=True)
+    with clock('filter'):
+        MarkerDataAllF, Segments = filter_markers(MarkerDataAll, fcut, Kva.FPS)
+    with clock('rename'):
+        MarkerDataAllF, OldCols, NewCols = rename_markers(MarkerDataAllF)
+        MarkerDataAllF = denormalize(MarkerDataAllF, Kva.ImX, Kva.ImY)
+    Result = Tracking(FileName=Kva.FileName, FPS=Kva.FPS, ImX=Kva.ImX, ImY=Kva.ImY, CalPx2Unit=Kva.CalPx2Unit,
+                      Units=Units, LineDataAll=LineDataAll, LineCal=LineCal, fcut=fcut, OldCols=OldCols,
+                      NewCols=NewCols, MarkerDataAllF=MarkerDataAllF, Continuous=len(Segments) <= 1,
+                      Segments=Segments, FPSText=Kva.FPSText)
+    with clock('write_csv'):
+        write_csv(Result, OutBase + '.csv')
+    with clock('write_npy'):
+        write_npy(Result, OutBase)
+    return Result
+
+
+class _Timer:
+    def __init__(self):
+        self.Values = {}
+
+    def __call__(self, Stage):
+        return _Span(self, Stage)
+
+
+class _Span:
+    def __init__(self, Timer, Stage):
+        self.Timer, self.Stage = Timer, Stage
+
+    def __enter__(self):
+        self.tic = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.Timer.Values[self.Stage] = time.perf_counter() - self.tic
+
+
+class _MemoryPeak(_Span):
+    # Peak of memory allocated by Python during the stage, above what was allocated before it
+    def __enter__(self):
+        self.Base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+
+    def __exit__(self, *exc):
+        self.Timer.Values[self.Stage] = (tracemalloc.get_traced_memory()[1] - self.Base) / 1e6
+
+
+def benchmark(markers=6, frames=100000, fps=60., lines=None, colon=True, gaps=0, repeat=3, memory=True, fcut=5,
+              parse_workers=None):
+    """Generate a synthetic file, then time each stage of its processing. Returns the results as a dict."""
+    with tempfile.TemporaryDirectory() as TmpDir:
+        FilePath = os.path.join(TmpDir, 'bench.kva')
+        nPoints = write_kva(FilePath, markers, frames, fps, lines, colon, gaps)
+        FileMB = os.path.getsize(FilePath) / 1e6
+        OutBase = os.path.join(TmpDir, 'bench.kva_Tracking')
+
+        Best = {}
+        for _ in range(repeat):
+            Timer = _Timer()
+            run_stages(FilePath, OutBase, fcut, Timer, parse_workers)
+            for Stage, Seconds in Timer.Values.items():
+                Best[Stage] = min(Best.get(Stage, Seconds), Seconds)
+
+        Peak = {}
+        if memory:
+            Memory = _Timer()
+            tracemalloc.start()
+            try:
+                run_stages(FilePath, OutBase, fcut, lambda Stage: _MemoryPeak(Memory, Stage), parse_workers)
+            finally:
+                tracemalloc.stop()
+            Peak = Memory.Values
+
+    Stages = {}
+    for Stage in STAGES:
+        Seconds = Best[Stage]
+        Stages[Stage] = {'seconds': round(Seconds, 5),
+                         'points_per_s': round(nPoints / Seconds) if Seconds > 0 else None,
+                         'mb_per_s': round(FileMB / Seconds, 2) if Seconds > 0 and Stage == 'parse' else None,
+                         'peak_mb': round(Peak[Stage], 2) if Stage in Peak else None}
+    return {'scenario': {'markers': markers, 'frames': frames, 'fps': fps, 'lines': lines, 'colon': colon,
+                         'gaps': gaps, 'fcut': fcut, 'parse_workers': parse_workers},
+            'points': nPoints, 'file_mb': round(FileMB, 2), 'repeat': repeat,
+            'total_seconds': round(sum(Best.values()), 5), 'stages': Stages}
+
+
+def compare(Results, Baseline, Tolerance=0.2, MinSlowdown=0.005):
+    """Ratio of each stage time to the baseline. Returns the rows (stage, baseline, now, ratio, regression).
+
+    A stage regressed if it is slower by more than the Tolerance fraction and by more than MinSlowdown seconds, so the
+    timer noise of millisecond stages is not reported.
+    """
+    if Results['scenario'] != Baseline['scenario']:
+        print(f'Warning: scenario differs from the baseline {Baseline["scenario"]}')
+    Rows = []
+    for Stage, Now in Results['stages'].items():
+        Before = Baseline['stages'].get(Stage, {}).get('seconds')
+        if not Before:
+            continue
+        Ratio = Now['seconds'] / Before
+        Rows.append((Stage, Before, Now['seconds'], Ratio,
+                     Ratio > 1 + Tolerance and Now['seconds'] - Before > MinSlowdown))
+    return Rows
+
+
+def print_results(Results):
+    print(f'{Results["points"]} track points, {Results["file_mb"]} MB .kva, best of {Results["repeat"]}')
+    print(f'{"stage":10s} {"seconds":>9s} {"points/s":>12s} {"MB/s":>7s} {"peak MB":>8s}')
+    for Stage, Row in Results['stages'].items():
+        print(f'{Stage:10s} {Row["seconds"]:9.4f} {Row["points_per_s"] or 0:12,d} '
+              f'{Row["mb_per_s"] or "":>7} {"" if Row["peak_mb"] is None else Row["peak_mb"]:>8}')
+    print(f'{"total":10s} {Results["total_seconds"]:9.4f}')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Time each processing stage on a synthetic .kva file.')
+    parser.add_argument('--markers', type=int, default=6)
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--fps', type=float, default=60.)
+    parser.add_argument('--lines', type=int, default=None, help='calibration lines, one per pair of markers by default')
+    parser.add_argument('--colon', action='store_true', help='M:SS.ff time strings instead of seconds')
+    parser.add_argument('--gaps', type=int, default=0, help='number of runs of skipped frames')
+    parser.add_argument('--cutoff', type=float, default=5)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--parse-workers', type=int, default=None, help='processes parsing the Track blocks')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory pass')
+    parser.add_argument('--save', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', help='compare with a JSON baseline saved before')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='slowdown reported as a regression, 0.2 = 20%%')
+    args = parser.parse_args(argv)
+
+    Results = benchmark(args.markers, args.frames, args.fps, args.lines, args.colon, args.gaps, args.repeat,
+                        not args.no_memory, args.cutoff, args.parse_workers)
+    print_results(Results)
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(Results, file, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            Rows = compare(Results, json.load(file), args.tolerance)
+        print(f'\n{"stage":10s} {"baseline":>9s} {"now":>9s} {"ratio":>6s}')
+        for Stage, Before, Now, Ratio, Regression in Rows:
+            print(f'{Stage:10s} {Before:9.4f} {Now:9.4f} {Ratio:6.2f}' + ('  REGRESSION' if Regression else ''))
+        if any(Row[4] for Row in Rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
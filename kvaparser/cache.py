@@ -0,0 +1,140 @@
+# On-disk cache of parse results, so re-running a file with another cutoff or line length skips the parsing.
+#
+# Entries are keyed by a hash of the file content and the parser version, so a copied or renamed file still hits and
+# a parser change invalidates everything. Hashing a large file takes a while too, so a small reference keyed by the
+# path, size and modification time points to the content key and makes the lookup of an unchanged file immediate.
+# Entries are plain uncompressed .npz files (arrays of each track and the rest as JSON). When the cache grows above
+# its size limit, the least recently used entries are removed.
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from kvaparser.parse import PARSER_VERSION, KvaData, TrackData, parse_kva, _line_table
+
+DEFAULT_CACHE_DIR = os.environ.get('KVAPARSER_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'kvaparser'))
+DEFAULT_CACHE_SIZE_MB = 2048
+_HASH_CHUNK = 1 << 22
+
+
+def content_key(FilePath):
+    Hash = hashlib.sha1(f'kvaparser {PARSER_VERSION}\n'.encode())
+    with open(FilePath, 'rb') as file:
+        for Chunk in iter(lambda: file.read(_HASH_CHUNK), b''):
+            Hash.update(Chunk)
+    return Hash.hexdigest()
+
+
+def _stat_ref(FilePath, CacheDir):
+    Stat = os.stat(FilePath)
+    Id = f'{os.path.abspath(FilePath)}|{Stat.st_size}|{Stat.st_mtime_ns}|{PARSER_VERSION}'
+    return os.path.join(CacheDir, hashlib.sha1(Id.encode()).hexdigest() + '.ref')
+
+
+def _atomic_write(Path, write):
+    # Write to a temporary file in the same folder, then move it in place, so concurrent readers never see half a file
+    fd, TmpPath = tempfile.mkstemp(dir=os.path.dirname(Path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            write(file)
+        os.replace(TmpPath, Path)
+    except BaseException:
+        if os.path.exists(TmpPath):
+            os.remove(TmpPath)
+        raise
+
+
+def save_kva(Kva, Path):
+    Meta = {'FileName': Kva.FileName, 'ImX': Kva.ImX, 'ImY': Kva.ImY, 'FPS': Kva.FPS, 'FPSText': Kva.FPSText,
+            'MarkerNames': Kva.MarkerNames, 'TrackNames': [Track.Name for Track in Kva.Tracks],
+            'LineNames': Kva.LineNames, 'LineDataAll': Kva.LineDataAll.to_dict(orient='list'),
+            'CalPx2Unit': float(Kva.CalPx2Unit), 'Units': Kva.Units, 'FirstTimeStamp': Kva.FirstTimeStamp,
+            'TimeStampsPerFrame': Kva.TimeStampsPerFrame}
+    Arrays = {'meta': np.array(json.dumps(Meta))}
+    for itrack, Track in enumerate(Kva.Tracks):
+        Arrays[f'X{itrack}'], Arrays[f'Y{itrack}'], Arrays[f'Time{itrack}'] = Track.X, Track.Y, Track.Time
+        if Track.Tick is not None:
+            Arrays[f'Tick{itrack}'] = Track.Tick
+    _atomic_write(Path, lambda file: np.savez(file, **Arrays))
+
+
+def load_kva(Path):
+    with np.load(Path, allow_pickle=False) as Arrays:
+        Meta = json.loads(str(Arrays['meta']))
+        Tracks = [TrackData(Name, Arrays[f'X{itrack}'], Arrays[f'Y{itrack}'], Arrays[f'Time{itrack}'],
+                            Arrays[f'Tick{itrack}'] if f'Tick{itrack}' in Arrays.files else None)
+                  for itrack, Name in enumerate(Meta['TrackNames'])]
+    return KvaData(FileName=Meta['FileName'], ImX=Meta['ImX'], ImY=Meta['ImY'], FPS=Meta['FPS'],
+                   FPSText=Meta['FPSText'], MarkerNames=Meta['MarkerNames'], Tracks=Tracks, LineNames=Meta['LineNames'],
+                   LineDataAll=_line_table(Meta['LineDataAll']),
+                   CalPx2Unit=Meta['CalPx2Unit'], Units=Meta['Units'], FirstTimeStamp=Meta['FirstTimeStamp'],
+                   TimeStampsPerFrame=Meta['TimeStampsPerFrame'])
+
+
+def evict(CacheDir, MaxBytes):
+    """Remove the least recently used entries until the cache fits in MaxBytes."""
+    Entries = []
+    for Name in os.listdir(CacheDir):
+        if Name.endswith('.npz'):
+            try:
+                Stat = os.stat(os.path.join(CacheDir, Name))
+            except FileNotFoundError: # evicted by another process meanwhile
+                continue
+            Entries.append((Stat.st_mtime, Stat.st_size, Name))
+    Total = sum(Size for _, Size, _ in Entries)
+    for _, Size, Name in sorted(Entries):
+        if Total <= MaxBytes:
+            break
+        try:
+            os.remove(os.path.join(CacheDir, Name))
+        except FileNotFoundError: # evicted by another process meanwhile
+            pass
+        Total -= Size
+    # Drop the references to removed entries
+    Keys = set(Name[:-4] for Name in os.listdir(CacheDir) if Name.endswith('.npz'))
+    for Name in os.listdir(CacheDir):
+        if Name.endswith('.ref'):
+            try:
+                with open(os.path.join(CacheDir, Name), 'r') as file:
+                    if file.read().strip() not in Keys:
+                        os.remove(os.path.join(CacheDir, Name))
+            except FileNotFoundError:
+                pass
+
+
+def parse_kva_cached(FilePath, CacheDir=None, MaxSizeMB=DEFAULT_CACHE_SIZE_MB, progress=True, Info=None, workers=None):
+    """parse_kva, with the result taken from (or stored to) the cache in CacheDir.
+
+    Info, if given, is a dict which gets 'cache': 'hit' or 'miss'.
+    """
+    Info = {} if Info is None else Info
+    CacheDir = CacheDir or DEFAULT_CACHE_DIR
+    os.makedirs(CacheDir, exist_ok=True)
+    RefPath = _stat_ref(FilePath, CacheDir)
+    Key = None
+    if os.path.isfile(RefPath):
+        with open(RefPath, 'r') as file:
+            Key = file.read().strip()
+    if Key is None or not os.path.isfile(os.path.join(CacheDir, Key + '.npz')):
+        Key = content_key(FilePath)
+        _atomic_write(RefPath, lambda file: file.write(Key.encode()))
+
+    EntryPath = os.path.join(CacheDir, Key + '.npz')
+    if os.path.isfile(EntryPath):
+        try:
+            Kva = load_kva(EntryPath)
+            os.utime(EntryPath) # most recently used
+            Kva.FileName = os.path.basename(FilePath)
+            Info['cache'] = 'hit'
+            return Kva
+        except (OSError, ValueError, KeyError): # evicted meanwhile, or a broken entry: parse again
+            pass
+
+    Info['cache'] = 'miss'
+    Kva = parse_kva(FilePath, progress=progress, workers=workers)
+    save_kva(Kva, EntryPath)
+    evict(CacheDir, MaxSizeMB * 1024 * 1024)
+    return Kva
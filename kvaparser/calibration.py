@@ -0,0 +1,201 @@
+# Normalization and calibration of marker coordinates.
+#
+# For markers, the default (if no calibration) origin is frame center, and axes surprisingly are classical X rightwards, Y upwards.
+# For lines, the default (if no calibration) origin is upper left corner, and axes are X rightwards, but Y downwards.
+# Shoutout to Kinovea with transparent implementation!!!
+# For more intuitive process, the origin is translated to bottom-left corner and coordinates are normalized by video size
+# until calibration. Calibration either uses the Kinovea calibration (if it can be safely applied to all the markers), or
+# a line per pair of markers (or a single line for all of them) drawn in Kinovea *without* calibrated length.
+#
+# Each calibration source (a line, or the Kinovea calibration) covers a set of markers, e.g. the video of one camera of
+# a composed video. The sources give every coordinate column a scale and a shift, and the marker matrix is calibrated
+# in a single broadcast, Calibrated = Normalized * Scale + Shift, whatever the number of sources and markers.
+
+import numpy as np
+
+# Default true lengths of the calibration lines: a colored pushpin (3/8") when there is a line per pair of markers,
+# the overall diameter of a reflective marker when a single line calibrates all of them.
+DEFAULT_PAIR_LENGTH = (9.5, 'mm')
+DEFAULT_SINGLE_LENGTH = (10., 'mm')
+
+
+def normalize(MarkerDataAll, LineDataAll, ImX, ImY):
+    """Translate the origin to bottom-left and normalize coordinates by the video size. Returns copies."""
+    MarkerDataAll = MarkerDataAll.copy()
+    LineDataAll = LineDataAll.copy()
+    for col in MarkerDataAll.columns:
+        if col.endswith('_X'):
+            MarkerDataAll.loc[:, col] = (MarkerDataAll.loc[:, col] + ImX/2) / ImX
+        elif col.endswith('_Y'):
+            MarkerDataAll.loc[:, col] = (MarkerDataAll.loc[:, col] + ImY/2) / ImY
+    LineDataAll.loc[:, 'Center_X'] = LineDataAll.loc[:, 'Center_X'] / ImX
+    LineDataAll.loc[:, 'Center_Y'] = (- LineDataAll.loc[:, 'Center_Y'] + ImY) / ImY
+    return MarkerDataAll, LineDataAll
+
+
+def denormalize(MarkerDataAll, ImX, ImY):
+    """Remove normalization by screen size."""
+    MarkerDataAll = MarkerDataAll.copy()
+    for col in MarkerDataAll.columns:
+        if col.endswith('_X'):
+            MarkerDataAll.loc[:, col] = MarkerDataAll.loc[:, col] * ImX
+        elif col.endswith('_Y'):
+            MarkerDataAll.loc[:, col] = MarkerDataAll.loc[:, col] * ImY
+    return MarkerDataAll
+
+
+def parse_length(strIn, Default):
+    """'10 mm' -> (10., 'mm'). An empty string gives the default, a malformed one raises ValueError."""
+    if isinstance(strIn, (int, float)):
+        return float(strIn), Default[1]
+    if isinstance(strIn, (list, tuple)):
+        return float(strIn[0]), str(strIn[1])
+    strIn = (strIn or '').strip()
+    if len(strIn) == 0:
+        return Default
+    Parts = strIn.split(' ')
+    if len(Parts) < 2:
+        raise ValueError(f'Length "{strIn}" must have units, separated with a space (e.g. 10 mm)')
+    return float(Parts[0]), Parts[1]
+
+
+def line_number(LineName):
+    # Line_1 -> '1', also 'Line 1' -> '1'
+    if '_' in LineName:
+        return LineName.rsplit('_', 1)[1]
+    if ' ' in LineName:
+        return LineName.rsplit(' ', 1)[1]
+    return None
+
+
+def suggest_line_markers(LineNames, MarkerNames):
+    """Autosuggest two markers per line: those with the matching _N number, otherwise by order of lines and trackers.
+
+    Returns a list of (marker pair, reason) in the order of lines.
+    """
+    Suggested = []
+    for iline, LineName in enumerate(LineNames):
+        iLn = line_number(LineName)
+        MatchingMark = [MarkName for MarkName in MarkerNames if iLn is not None and line_number(MarkName) == iLn]
+        if len(MatchingMark) == 2:
+            Suggested.append((MatchingMark, f'based on a matching number {iLn} in two marker names'))
+        else:
+            Suggested.append((MarkerNames[(iline*2):(iline*2+2)], 'based on order of lines and trackers'))
+    return Suggested
+
+
+def calibration_mode(CalPx2Unit, nMarkers, nLines, Mapped=False):
+    """'kinovea' (the Kinovea calibration for all markers), 'single' (one line for all markers) or 'pairs' (each line
+    calibrates its own markers, a pair by default).
+
+    Mapped tells that the markers of some lines are given explicitly, which selects 'pairs' whatever the numbers of
+    lines and markers; with a Kinovea calibration, the markers of no line then keep it.
+    """
+    if Mapped and nLines > 0:
+        return 'pairs'
+    if not (CalPx2Unit == 1):
+        return 'kinovea'
+    if nLines > 0 and 2 * nLines == nMarkers:
+        return 'pairs'
+    if nLines == 1:
+        return 'single'
+    if nLines > 1:
+        return 'pairs'
+    raise ValueError('Markers can only be calibrated with a line drawn in Kinovea, or with the Kinovea calibration.')
+
+
+def source_vectors(Columns, Sources, CalPx2Unit, Origins=None):
+    """Per-column Scale and Shift calibrating normalized coordinates, Calibrated = Normalized * Scale + Shift.
+
+    Sources are (name, markers, factor) with the factor of the source's line in units per pixel, or None for the
+    Kinovea calibration (whose coordinates already are in units). Origins maps source names to the origin of their
+    markers, in normalized video coordinates (bottom-left origin, as the line centers), so that e.g. each camera of a
+    composed video gets its own origin. Columns not covered by any source keep Scale 1 and Shift 0.
+    """
+    Origins = Origins or {}
+    Index = {col: icol for icol, col in enumerate(Columns)}
+    Scale = np.ones(len(Columns))
+    Shift = np.zeros(len(Columns))
+    for Name, Markers, Factor in Sources:
+        Cols = [Index[MarkName + Axis] for MarkName in Markers for Axis in ('_X', '_Y') if MarkName + Axis in Index]
+        # X, Y, X, Y... along the columns
+        Origin = np.resize(np.asarray(Origins.get(Name, (0., 0.)), dtype=float), len(Cols))
+        if Factor is None:
+            # Kinovea units, only moved to the source's origin
+            Shift[Cols] = - Origin * CalPx2Unit
+        else:
+            # Kinovea-calibrated coordinates are brought back to pixels first
+            Scale[Cols] = Factor / CalPx2Unit
+            Shift[Cols] = (0.5 - 0.5 / CalPx2Unit - Origin) * Factor
+    return Scale, Shift
+
+
+def _check_global(nMarkers, AllowGlobalCalibration):
+    if nMarkers > 2 and not AllowGlobalCalibration:
+        raise ValueError(f'{nMarkers} markers share the Kinovea calibration, there might be different video '
+                         'sources with different scales composed in one. Allow global calibration to proceed.')
+
+
+def calibrate(MarkerDataAll, LineDataAll, MarkerNames, CalPx2Unit, Units, LineLengths=None, LineMarkers=None,
+              AllowGlobalCalibration=False, Origins=None):
+    """Calibrate normalized marker coordinates.
+
+    LineLengths maps line names to their true length ('10 mm', a number in mm or a (length, units) pair), missing lines
+    get the default length. LineMarkers maps line names to the markers calibrated by them (any number, e.g. all the
+    markers seen by one camera), missing lines get the autosuggested pair and lines mapped to no markers are not used.
+    With a Kinovea calibration, the markers of no line keep it (the true lengths of the lines should then be given in
+    the Kinovea units). Origins maps line names (and 'kinovea') to the origin of their markers, see source_vectors.
+    Returns the calibrated markers, the line table with true lengths, the per-line calibration factors and the units.
+    """
+    LineLengths = LineLengths or {}
+    LineMarkers = LineMarkers or {}
+    MarkerDataAll = MarkerDataAll.copy()
+    LineDataAll = LineDataAll.copy()
+    LineCal = []
+    LineNames = list(LineDataAll['Name'])
+    Mode = calibration_mode(CalPx2Unit, len(MarkerNames), len(LineDataAll),
+                            Mapped=any(LineName in LineMarkers for LineName in LineNames))
+
+    # (name, markers, units/px) of each calibration source
+    Sources = []
+    if Mode == 'kinovea':
+        # Kinovea already reports calibrated coordinates
+        _check_global(len(MarkerNames), AllowGlobalCalibration)
+        Sources.append(('kinovea', MarkerNames, None))
+    else:
+        Default = DEFAULT_PAIR_LENGTH if Mode == 'pairs' else DEFAULT_SINGLE_LENGTH
+        Lengths = [parse_length(LineLengths.get(LineName, ''), Default) for LineName in LineNames]
+        LineDataAll['Units'] = 'None'
+        LineDataAll['True L'] = [TrueL for TrueL, _ in Lengths]
+        LineDataAll['Units'] = [LineUnits for _, LineUnits in Lengths]
+        LineCal = (LineDataAll['True L'] / LineDataAll['Pixel L']).tolist()
+        Units = Lengths[-1][1]
+
+    if Mode == 'single':
+        Sources.append((LineNames[0], MarkerNames, LineCal[0]))
+    elif Mode == 'pairs':
+        Suggested = suggest_line_markers(LineNames, MarkerNames)
+        Source = {} # marker -> its line
+        for iline, LineName in enumerate(LineNames):
+            Ln2Mark = LineMarkers[LineName] if LineName in LineMarkers else Suggested[iline][0]
+            if isinstance(Ln2Mark, str):
+                Ln2Mark = Ln2Mark.split(',') if Ln2Mark.strip() else []
+            if not Ln2Mark:
+                continue
+            if not set(Ln2Mark) <= set(MarkerNames):
+                raise ValueError(f'Line {LineName} must be mapped to markers among {MarkerNames}, got {Ln2Mark}')
+            for MarkName in Ln2Mark:
+                if MarkName in Source:
+                    raise ValueError(f'Marker {MarkName} is mapped to both lines {Source[MarkName]} and {LineName}')
+                Source[MarkName] = LineName
+            Sources.append((LineName, Ln2Mark, LineCal[iline]))
+        Unmapped = [MarkName for MarkName in MarkerNames if MarkName not in Source]
+        if Unmapped:
+            if CalPx2Unit == 1:
+                raise ValueError(f'Markers {Unmapped} are not mapped to any calibration line')
+            _check_global(len(Unmapped), AllowGlobalCalibration)
+            Sources.append(('kinovea', Unmapped, None))
+
+    Scale, Shift = source_vectors(list(MarkerDataAll.columns[1:]), Sources, CalPx2Unit, Origins)
+    MarkerDataAll.iloc[:, 1:] = MarkerDataAll.iloc[:, 1:].to_numpy(dtype=float) * Scale + Shift
+    return MarkerDataAll, LineDataAll, LineCal, Units
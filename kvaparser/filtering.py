@@ -0,0 +1,207 @@
+# Low-pass filtering of marker coordinates with the same filter (and almost the same edge-padding) as in Kinovea.
+#
+# All the channels are filtered at once along the time axis. The data are first split into continuous segments: all
+# the channels break at every skipped frame, each channel also breaks where its marker is missing (NaN left by the
+# alignment on the first marker), so a gap never leaks into the filtered signal. Each segment gets its own edge-padding.
+# scipy is imported by the functions which filter, not with the module.
+
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+
+import numpy as np
+
+from kvaparser.align import frame_index
+
+DEFAULT_CUTOFF = 5
+# Segments shorter than this are too short for a meaningful zero-lag filtering and are left unfiltered
+MIN_SEGMENT = 10
+# Short segments listed by describe_segments, the others are only counted
+MAX_LISTED = 10
+
+# Rows [Start, Stop) of the data and the channels continuous over them
+Segment = namedtuple('Segment', ['Start', 'Stop', 'Channels', 'Short'])
+
+
+def check_continuity(Time):
+    """Check whether the user moved the Kinovea time slider too fast and skipped frames during autotracking.
+
+    Returns True if the time steps are regular.
+    """
+    dts = np.diff(np.asarray(Time, dtype=float))
+    if len(dts) == 0:
+        return True
+    return not np.any(np.abs(dts - np.mean(dts)) > 0.5 * np.mean(dts))
+
+
+def check_cutoff(fcut, FPS):
+    fcut = float(fcut)
+    fcut_norm = fcut / float(FPS) * 2
+    if not ((fcut_norm > 0) & (fcut_norm < 1)):
+        raise ValueError(f'Cutoff frequency must be between 0 and a half of the sampling rate ({FPS:g} fps), got {fcut}')
+    return fcut_norm
+
+
+def find_segments(Frame, Data):
+    """Split frames x channels data into continuous segments, at skipped frames and at NaN gaps of each channel.
+
+    Channels with data over exactly the same rows share a segment, so gap-free data give a single one. Raises
+    ValueError if a frame is repeated, which would split the data into segments of a single row.
+    """
+    Frame = np.asarray(Frame)
+    Valid = np.isfinite(Data)
+    n = len(Frame)
+    if n == 0:
+        return []
+    Step = np.diff(Frame)
+    nRepeated = np.count_nonzero(Step == 0)
+    if nRepeated:
+        raise ValueError(f'{nRepeated} rows repeat the frame of the previous row, first at row '
+                         f'{np.argmax(Step == 0) + 1}; are the times precise enough for the frame rate?')
+    # Skipped frames break all the channels, NaN runs only their own
+    TimeBreak = np.ones(n + 1, dtype=bool)
+    TimeBreak[1:n] = Step != 1
+    Prev = np.zeros_like(Valid)
+    Prev[1:] = Valid[:-1]
+    Next = np.zeros_like(Valid)
+    Next[:-1] = Valid[1:]
+    StartCh, StartRow = np.nonzero((Valid & (~Prev | TimeBreak[:n, None])).T)
+    StopCh, StopRow = np.nonzero((Valid & (~Next | TimeBreak[1:, None])).T)
+
+    Groups = {}
+    for ch, Start, Stop in zip(StartCh, StartRow, StopRow + 1):
+        Groups.setdefault((Start, Stop), []).append(ch)
+    return [Segment(int(Start), int(Stop), np.array(Channels), bool(Stop - Start < MIN_SEGMENT))
+            for (Start, Stop), Channels in sorted(Groups.items())]
+
+
+def _filter_segments(Data, Segments, sos, DataF, Channels=None):
+    # Filter the segments in place into DataF, restricted to Channels if given
+    from scipy.signal import sosfiltfilt
+    for Seg in Segments:
+        if Seg.Short:
+            continue
+        SegChannels = Seg.Channels if Channels is None else np.intersect1d(Seg.Channels, Channels)
+        if len(SegChannels) == 0:
+            continue
+        nseg = Seg.Stop - Seg.Start
+        if len(SegChannels) == Data.shape[1]:
+            DataF[Seg.Start:Seg.Stop] = sosfiltfilt(sos, Data[Seg.Start:Seg.Stop], axis=0, padtype='odd',
+                                                    padlen=min(50, int(nseg / 10)))
+        else:
+            DataF[Seg.Start:Seg.Stop, SegChannels] = sosfiltfilt(sos, Data[Seg.Start:Seg.Stop, SegChannels], axis=0,
+                                                                 padtype='odd', padlen=min(50, int(nseg / 10)))
+    return DataF
+
+
+def filter_array(Data, Frame, fcut, FPS, Segments=None):
+    """Zero-shift second-order Butterworth low-pass filter of a frames x channels array, segment by segment.
+
+    fcut is a single cutoff frequency or one per channel. Returns the filtered array (NaN where the input was NaN, raw
+    values in too short segments) and the segments.
+    """
+    from scipy.signal import butter
+    if Segments is None:
+        Segments = find_segments(Frame, Data)
+    DataF = Data.copy()
+    if np.ndim(fcut) == 0:
+        sos = butter(2, check_cutoff(fcut, FPS), btype='low', analog=False, output='sos')
+        return _filter_segments(Data, Segments, sos, DataF), Segments
+    # Channels sharing a cutoff are filtered together
+    fcut = np.asarray(fcut, dtype=float)
+    for fc in np.unique(fcut):
+        sos = butter(2, check_cutoff(fc, FPS), btype='low', analog=False, output='sos')
+        _filter_segments(Data, Segments, sos, DataF, Channels=np.flatnonzero(fcut == fc))
+    return DataF, Segments
+
+
+def default_cutoffs(FPS):
+    # 0.5 Hz steps up to 20 Hz, or to 0.45 of the sampling rate for low frame rates
+    return np.arange(0.5, min(20, 0.45 * FPS) + 1e-9, 0.5)
+
+
+def _residuals(Data, Segments, Used, Cutoffs, FPS):
+    # RMS difference between raw and filtered data, cutoffs x channels
+    from scipy.signal import butter
+    Residuals = np.zeros((len(Cutoffs), Data.shape[1]))
+    nUsed = np.maximum(Used.sum(axis=0), 1)
+    for icut, fc in enumerate(Cutoffs):
+        sos = butter(2, check_cutoff(fc, FPS), btype='low', analog=False, output='sos')
+        DataF = _filter_segments(Data, Segments, sos, Data.copy())
+        Residuals[icut] = np.sqrt((np.where(Used, Data - DataF, 0)**2).sum(axis=0) / nUsed)
+    return Residuals
+
+
+def residual_analysis(Data, Frame, FPS, Cutoffs=None, workers=None, FitFrom=0.5):
+    """Optimal cutoff frequency of each channel by residual analysis (Winter, Biomechanics and Motor Control of Human
+    Movement, ch. 3).
+
+    The RMS residual between raw and filtered data is computed over a grid of cutoffs for all the channels at once.
+    A line fitted to the residuals at the high cutoffs (from the FitFrom fraction of the grid on), where they are
+    dominated by noise, crosses zero cutoff at the noise level; the optimal cutoff is the lowest one whose residual
+    drops to it. The grid can be split across worker processes.
+    Returns the cutoffs, the residuals (cutoffs x channels) and the optimal cutoff per channel.
+    """
+    Cutoffs = default_cutoffs(FPS) if Cutoffs is None else np.asarray(Cutoffs, dtype=float)
+    for fc in Cutoffs:
+        check_cutoff(fc, FPS)
+    Segments = find_segments(Frame, Data)
+    Used = np.zeros(Data.shape, dtype=bool)
+    for Seg in Segments:
+        if not Seg.Short:
+            Used[Seg.Start:Seg.Stop, Seg.Channels] = True
+
+    if workers and workers > 1 and len(Cutoffs) > 1:
+        Chunks = np.array_split(Cutoffs, min(workers, len(Cutoffs)))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            Residuals = np.vstack(list(pool.map(_residuals, repeat(Data), repeat(Segments), repeat(Used), Chunks,
+                                                repeat(FPS))))
+    else:
+        Residuals = _residuals(Data, Segments, Used, Cutoffs, FPS)
+
+    # Noise level: intercept of the line through the high-cutoff residuals, fitted for all channels at once
+    Fit = slice(int(len(Cutoffs) * FitFrom), None)
+    Slope, Intercept = np.polyfit(Cutoffs[Fit], Residuals[Fit], 1)
+    Below = Residuals <= Intercept
+    # Lowest cutoff at or below the noise level, the highest one if the residuals never get there
+    Optimal = np.where(Below.any(axis=0), Cutoffs[np.argmax(Below, axis=0)], Cutoffs[-1])
+    return Cutoffs, Residuals, Optimal
+
+
+def filter_markers(MarkerDataAll, fcut, FPS):
+    """Filter all the coordinate columns of a Time, X, Y... table at a single cutoff or one per column.
+
+    Returns the filtered copy and the segments.
+    """
+    Frame = frame_index(MarkerDataAll, FPS)
+    DataF, Segments = filter_array(MarkerDataAll.iloc[:, 1:].to_numpy(dtype=float), Frame, fcut, FPS)
+    MarkerDataAllF = MarkerDataAll.copy()
+    MarkerDataAllF.iloc[:, 1:] = DataF
+    return MarkerDataAllF, Segments
+
+
+def auto_cutoff(MarkerDataAll, FPS, Cutoffs=None, workers=None):
+    """Residual analysis of all the coordinate columns of a Time, X, Y... table.
+
+    Returns the optimal cutoff per column and the residual curves as a table with a Cutoff column.
+    """
+    import pandas as pd
+    Frame = frame_index(MarkerDataAll, FPS)
+    Cutoffs, Residuals, Optimal = residual_analysis(MarkerDataAll.iloc[:, 1:].to_numpy(dtype=float), Frame, FPS,
+                                                    Cutoffs=Cutoffs, workers=workers)
+    ResidualTable = pd.DataFrame(Residuals, columns=MarkerDataAll.columns[1:])
+    ResidualTable.insert(0, 'Cutoff', Cutoffs)
+    return Optimal, ResidualTable
+
+
+def describe_segments(Segments):
+    """A sentence for the output header and the console, empty if the data are a single continuous segment."""
+    if len(Segments) <= 1 and not any(Seg.Short for Seg in Segments):
+        return ''
+    Short = [Seg for Seg in Segments if Seg.Short]
+    Desc = f'The data have gaps and were filtered separately in {len(Segments)} continuous segments'
+    if Short:
+        Desc += f', {len(Short)} of them shorter than {MIN_SEGMENT} frames were left unfiltered (rows ' + \
+                ', '.join(f'{Seg.Start}-{Seg.Stop - 1}' for Seg in Short[:MAX_LISTED]) + \
+                (f' and {len(Short) - MAX_LISTED} more' if len(Short) > MAX_LISTED else '') + ')'
+    return Desc + '.'
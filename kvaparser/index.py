@@ -0,0 +1,180 @@
+# Index of the sessions of a study: the metadata of every .kva file in a directory tree, in an SQLite database.
+#
+#   python -m kvaparser.index STUDY_DIR --db study.sqlite
+#   python -m kvaparser.index STUDY_DIR --db study.sqlite --where "fps >= 100 AND NOT calibrated" --json
+#
+# Each file is scanned without parsing its track points (see parse.read_header): video properties, Kinovea
+# calibration, marker and line names, and the number of points and first and last times of each track, read from the
+# TrackPointList Count and its first and last TrackPoint. The index is updated incrementally: a file is scanned again
+# only if its size or modification time changed, or if the scanner changed (INDEX_VERSION), and the files which
+# disappeared are removed. A file which cannot be scanned gets a row with its error, and is not retried until it changes.
+
+import argparse
+import json
+import mmap
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from kvaparser.parse import KvaData, _read_header, check_header, track_summary
+from kvaparser.batch import find_kva_files
+
+# Bump when the scanned columns change, to re-scan every file
+INDEX_VERSION = 1
+DEFAULT_INDEX = 'kva_index.sqlite'
+
+# Column name -> SQL type, lists are stored as JSON
+COLUMNS = {
+    'path': 'TEXT PRIMARY KEY',
+    'size': 'INTEGER',
+    'mtime_ns': 'INTEGER',
+    'version': 'INTEGER',
+    'file': 'TEXT',
+    'fps': 'REAL',
+    'image_x': 'INTEGER',
+    'image_y': 'INTEGER',
+    'calibrated': 'INTEGER', # a calibrated line in Kinovea, all the coordinates are in its units
+    'cal_factor': 'REAL',
+    'units': 'TEXT',
+    'n_markers': 'INTEGER',
+    'markers': 'TEXT',
+    'n_lines': 'INTEGER',
+    'lines': 'TEXT',
+    'track_points': 'TEXT', # points of each track, in the order of markers
+    'points': 'INTEGER',
+    'start': 'REAL', # first and last times of all the tracks, s
+    'stop': 'REAL',
+    'duration': 'REAL',
+    'error': 'TEXT',
+}
+_JSON = ('markers', 'lines', 'track_points')
+
+
+def scan_kva(FilePath):
+    """Metadata of a .kva file as an index row (a dict of COLUMNS)."""
+    Stat = os.stat(FilePath)
+    Row = dict.fromkeys(COLUMNS)
+    Row.update(path=FilePath, size=Stat.st_size, mtime_ns=Stat.st_mtime_ns, version=INDEX_VERSION,
+               file=os.path.basename(FilePath))
+    try:
+        Kva = KvaData(FileName=Row['file'])
+        Summaries = []
+        if Stat.st_size > 0:
+            with open(FilePath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as Buffer:
+                _, TrackBlocks = _read_header(Buffer, Kva)
+                Summaries = [track_summary(Buffer, Block) for Block in TrackBlocks]
+        check_header(Kva)
+    except Exception as err:
+        Row['error'] = f'{type(err).__name__}: {err}'
+        return Row
+    Counts = [Count for Count, _, _ in Summaries]
+    Starts = [Start for _, Start, _ in Summaries if not np.isnan(Start)]
+    Stops = [Stop for _, _, Stop in Summaries if not np.isnan(Stop)]
+    Row.update(fps=Kva.FPS, image_x=Kva.ImX, image_y=Kva.ImY, calibrated=int(Kva.CalPx2Unit != 1),
+               cal_factor=Kva.CalPx2Unit, units=Kva.Units, n_markers=len(Kva.MarkerNames), markers=Kva.MarkerNames,
+               n_lines=len(Kva.LineNames), lines=Kva.LineNames, track_points=Counts, points=sum(Counts),
+               start=min(Starts) if Starts else None, stop=max(Stops) if Stops else None)
+    if Starts:
+        Row['duration'] = Row['stop'] - Row['start']
+    return Row
+
+
+def _connect(IndexPath):
+    Connection = sqlite3.connect(IndexPath)
+    Connection.execute('CREATE TABLE IF NOT EXISTS sessions (' +
+                       ', '.join(f'{Name} {Type}' for Name, Type in COLUMNS.items()) + ')')
+    return Connection
+
+
+def _to_sql(Row):
+    return [json.dumps(Row[Name]) if Name in _JSON and Row[Name] is not None else Row[Name] for Name in COLUMNS]
+
+
+def _from_sql(Values, Names):
+    Row = dict(zip(Names, Values))
+    for Name in _JSON:
+        if Row.get(Name) is not None:
+            Row[Name] = json.loads(Row[Name])
+    if Row.get('calibrated') is not None:
+        Row['calibrated'] = bool(Row['calibrated'])
+    return Row
+
+
+def update_index(Paths, IndexPath=DEFAULT_INDEX, Workers=None, Prune=True):
+    """Scan the .kva files found in Paths which are new or changed since they were indexed in IndexPath.
+
+    Files are scanned in a process pool when Workers > 1. With Prune, the indexed files which no longer exist are
+    removed. Returns the numbers of scanned, unchanged and removed files.
+    """
+    Files = find_kva_files(Paths)
+    with _connect(IndexPath) as Connection:
+        Known = {Path: (Size, MtimeNs, Version) for Path, Size, MtimeNs, Version in
+                 Connection.execute('SELECT path, size, mtime_ns, version FROM sessions')}
+        ToScan = []
+        for FilePath in Files:
+            try:
+                Stat = os.stat(FilePath)
+            except FileNotFoundError:
+                continue
+            if Known.get(FilePath) != (Stat.st_size, Stat.st_mtime_ns, INDEX_VERSION):
+                ToScan.append(FilePath)
+        if Workers and Workers > 1 and len(ToScan) > 1:
+            with ProcessPoolExecutor(max_workers=Workers) as pool:
+                Rows = list(pool.map(scan_kva, ToScan, chunksize=max(1, len(ToScan) // (4 * Workers))))
+        else:
+            Rows = [scan_kva(FilePath) for FilePath in ToScan]
+        Connection.executemany(f'INSERT OR REPLACE INTO sessions VALUES ({", ".join("?" * len(COLUMNS))})',
+                               [_to_sql(Row) for Row in Rows])
+        Removed = []
+        if Prune:
+            Removed = [Path for Path in Known if not os.path.isfile(Path)]
+            Connection.executemany('DELETE FROM sessions WHERE path = ?', [(Path,) for Path in Removed])
+    Connection.close()
+    return len(Rows), len(Files) - len(Rows), len(Removed)
+
+
+def query_index(IndexPath=DEFAULT_INDEX, Where=None, Params=()):
+    """Rows of the index as dicts, ordered by path, optionally filtered by an SQL condition on COLUMNS."""
+    Connection = _connect(IndexPath)
+    try:
+        Cursor = Connection.execute('SELECT * FROM sessions' + (f' WHERE {Where}' if Where else '') + ' ORDER BY path',
+                                    Params)
+        Names = [Description[0] for Description in Cursor.description]
+        return [_from_sql(Values, Names) for Values in Cursor]
+    finally:
+        Connection.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Index the metadata of .kva files without parsing their track points.')
+    parser.add_argument('paths', nargs='*', help='.kva files, directories (searched recursively) or glob patterns')
+    parser.add_argument('--db', default=DEFAULT_INDEX, help=f'SQLite index to update and query, {DEFAULT_INDEX} by default')
+    parser.add_argument('--workers', type=int, default=None, help='processes scanning the new and changed files')
+    parser.add_argument('--where', help='list only the sessions matching this SQL condition, e.g. "fps >= 100"')
+    parser.add_argument('--json', action='store_true', help='list the sessions as JSON')
+    args = parser.parse_args(argv)
+
+    if args.paths:
+        Scanned, Unchanged, Removed = update_index(args.paths, args.db, args.workers)
+        print(f'{Scanned} scanned, {Unchanged} unchanged, {Removed} removed', file=sys.stderr)
+    Rows = query_index(args.db, args.where)
+    if args.json:
+        json.dump(Rows, sys.stdout, indent=1)
+        print()
+        return 0
+    for Row in Rows:
+        if Row['error']:
+            print(f'{Row["path"]}: {Row["error"]}')
+            continue
+        Duration = '' if Row['duration'] is None else f'{Row["duration"]:.1f} s'
+        print(f'{Row["path"]}: {Row["fps"]:g} fps, {Row["image_x"]}x{Row["image_y"]}, {Duration}, '
+              f'{Row["n_markers"]} markers {Row["markers"]}, {Row["n_lines"]} lines {Row["lines"]}'
+              + (f', calibrated {Row["cal_factor"]} {Row["units"]}/px' if Row['calibrated'] else ''))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
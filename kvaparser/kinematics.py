@@ -0,0 +1,78 @@
+# Kinematics of each pair of markers, derived from the filtered and renamed marker data.
+#
+# For each pair (D1, P1), (D2, P2)... the proximal-distal distance and the projection of the 4 coordinates of the pair
+# on their first principal component, each with its first and second time derivatives. All the pairs are computed at
+# once on a frames x pairs x 4 array. Derivatives are central differences at the frame rate within each run of
+# consecutive frames, so they never span skipped frames.
+
+import numpy as np
+
+from kvaparser.align import frame_index
+
+# Quantities per pair, each followed by its derivatives (_V, _A) in the output columns
+QUANTITIES = ('Dist', 'PC1')
+
+
+def pair_distance(Pairs):
+    """Distance between the two markers of each pair, frames x pairs, from a frames x pairs x (X1, Y1, X2, Y2) array."""
+    return np.hypot(Pairs[..., 0] - Pairs[..., 2], Pairs[..., 1] - Pairs[..., 3])
+
+
+def first_component(Pairs):
+    """Projection of each pair's 4 coordinates on their first principal component, frames x pairs.
+
+    The covariance of each pair is taken over the frames where the 4 coordinates are known, the projection is NaN
+    elsewhere. The component is signed so that its largest loading is positive, for a reproducible direction. Returns
+    the projections and the components (pairs x 4).
+    """
+    Valid = np.isfinite(Pairs).all(axis=2)
+    Count = Valid.sum(axis=0)
+    Mean = np.where(Valid[..., None], Pairs, 0).sum(axis=0) / np.maximum(Count, 1)[:, None]
+    Centered = Pairs - Mean
+    Known = np.where(Valid[..., None], Centered, 0)
+    Cov = np.einsum('fpi,fpj->pij', Known, Known) / np.maximum(Count - 1, 1)[:, None, None]
+    # Eigenvalues in ascending order, the last vector is the first component
+    Components = np.linalg.eigh(Cov)[1][:, :, -1]
+    Sign = np.sign(Components[np.arange(len(Components)), np.abs(Components).argmax(axis=1)])
+    Components = Components * np.where(Sign == 0, 1, Sign)[:, None]
+    return np.einsum('fpi,pi->fp', Centered, Components), Components
+
+
+def derivatives(Signal, Frame, FPS):
+    """First and second time derivatives of a frames x channels signal, NaN on runs of less than 3 frames."""
+    Vel = np.full(Signal.shape, np.nan)
+    Acc = np.full(Signal.shape, np.nan)
+    Breaks = np.flatnonzero(np.diff(Frame) != 1) + 1
+    for Start, Stop in zip(np.r_[0, Breaks], np.r_[Breaks, len(Frame)]):
+        if Stop - Start < 3:
+            continue
+        Vel[Start:Stop] = np.gradient(Signal[Start:Stop], 1 / FPS, axis=0)
+        Acc[Start:Stop] = np.gradient(Vel[Start:Stop], 1 / FPS, axis=0)
+    return Vel, Acc
+
+
+def pair_kinematics(MarkerDataAllF, FPS):
+    """Kinematics of the pairs of a Time, D1_X, D1_Y, P1_X, P1_Y, D2_X... table (as renamed by rename_markers).
+
+    Returns a table with, for each pair, D1P1_Dist, D1P1_Dist_V, D1P1_Dist_A, D1P1_PC1, D1P1_PC1_V, D1P1_PC1_A...
+    in the units of the marker data (per second, per second squared for the derivatives). A last unpaired marker is
+    left out.
+    """
+    import pandas as pd
+    Cols = list(MarkerDataAllF.columns[1:])
+    nPairs = len(Cols) // 4
+    Names = [Cols[4 * ipair][:-2] + Cols[4 * ipair + 2][:-2] for ipair in range(nPairs)]
+    Data = MarkerDataAllF.iloc[:, 1:1 + 4 * nPairs].to_numpy(dtype=float)
+    Pairs = Data.reshape(len(Data), nPairs, 4)
+    Frame = frame_index(MarkerDataAllF, FPS)
+
+    Quantities = {'Dist': pair_distance(Pairs), 'PC1': first_component(Pairs)[0]}
+    # Each quantity and its derivatives, frames x pairs
+    Series = {Quantity: (Quantities[Quantity],) + derivatives(Quantities[Quantity], Frame, FPS)
+              for Quantity in QUANTITIES}
+    Columns = {}
+    for ipair, Name in enumerate(Names):
+        for Quantity in QUANTITIES:
+            for Suffix, Values in zip(('', '_V', '_A'), Series[Quantity]):
+                Columns[f'{Name}_{Quantity}{Suffix}'] = Values[:, ipair]
+    return pd.DataFrame(Columns, index=MarkerDataAllF.index)
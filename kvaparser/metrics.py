@@ -0,0 +1,161 @@
+# Per-stage metrics of a run: wall time, CPU time, peak memory and item counts, as a JSON-serializable dict.
+#
+#   Metrics = RunMetrics(hook=print_stage)
+#   with Metrics.stage('parse') as Stage:
+#       Kva = parse_kva(FilePath)
+#       Stage.update(markers=len(Kva.MarkerNames))
+#   Metrics.write(OutBase + '.metrics.json')
+#
+# Memory is the resident set size (RSS) of the process when each stage starts and ends, from psutil if installed, else
+# from /proc/self/statm. The peak RSS of a stage comes from the high-water mark of the process, reset when the stage
+# starts (Linux only, through /proc/self/clear_refs), so it belongs to the stage and not to whatever ran before in the
+# same process, e.g. another file in a batch worker. Elsewhere (Windows, macOS) the stage peak is left empty and the
+# peak of the whole process so far is recorded instead as process_peak_rss_mb, from psutil (Windows) or the resource
+# module; values that cannot be read on the system are left empty (on Windows, install psutil). The peak of the run is
+# the highest of its stages, to compare with the RSS when the run started (the memory a previous run in the same
+# process left allocated). Stages do not nest.
+# Note that resetting the high-water mark changes it for the whole process: code measuring its own peak with VmHWM or
+# ru_maxrss around a call to the pipeline only sees the peak since the last stage started.
+# The hook, if given, is called with each stage's record as it ends.
+
+import json
+import os
+import sys
+import time
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def rss_mb():
+    """Resident set size of this process, MB, None if it cannot be read on this system."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / 2**20
+    try:
+        with open('/proc/self/statm', 'rb') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def reset_peak():
+    """Reset the high-water mark of the resident set size of this process. Returns False if it cannot be reset."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """High-water mark of the resident set size of this process since reset_peak, MB, None if it cannot be read."""
+    try:
+        with open('/proc/self/status', 'rb') as file:
+            for line in file:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def process_peak_rss_mb():
+    """High-water mark of the resident set size of this process since it started (since reset_peak on Linux), MB,
+    None if it cannot be read on this system."""
+    if psutil is not None:
+        Info = psutil.Process().memory_info()
+        # peak_wset on Windows; elsewhere psutil has no peak, resource gives it
+        if hasattr(Info, 'peak_wset'):
+            return Info.peak_wset / 2**20
+    if resource is not None:
+        MaxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Bytes on macOS, KB elsewhere
+        return MaxRss / 2**20 if sys.platform == 'darwin' else MaxRss / 2**10
+    return None
+
+
+def _mb(Value):
+    return None if Value is None else round(Value, 1)
+
+
+class _Stage(dict):
+    # Record of one stage; counts are added with update() while it runs
+    def __init__(self, Metrics, Name, Counts):
+        super().__init__(Counts)
+        self.Metrics, self.Name = Metrics, Name
+
+    def __enter__(self):
+        self.Rss = rss_mb()
+        self.Reset = reset_peak()
+        self.tic, self.cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def __exit__(self, ExcType, *exc):
+        Record = {'stage': self.Name,
+                  'wall_s': round(time.perf_counter() - self.tic, 6),
+                  'cpu_s': round(time.process_time() - self.cpu, 6),
+                  'rss_start_mb': _mb(self.Rss),
+                  'rss_end_mb': _mb(rss_mb()),
+                  'peak_rss_mb': _mb(peak_rss_mb()) if self.Reset else None,
+                  'process_peak_rss_mb': None if self.Reset else _mb(process_peak_rss_mb())}
+        if ExcType is not None:
+            Record['failed'] = ExcType.__name__
+        Record.update(self)
+        self.Metrics.Stages.append(Record)
+        if self.Metrics.hook is not None:
+            self.Metrics.hook(Record)
+
+
+class RunMetrics:
+    """Metrics of the stages of one run, in the order they ran. A stage may appear several times (e.g. write)."""
+
+    def __init__(self, FilePath=None, hook=None):
+        self.FilePath = FilePath
+        self.hook = hook
+        self.Stages = []
+        self.Rss = rss_mb()
+        self.tic, self.cpu = time.perf_counter(), time.process_time()
+
+    def stage(self, Name, **Counts):
+        """Context manager timing a stage. Item counts can be given here or added to the returned record."""
+        return _Stage(self, Name, Counts)
+
+    def peak_rss_mb(self):
+        """Highest peak RSS of the stages, MB, None if unknown."""
+        Peaks = [Record['peak_rss_mb'] for Record in self.Stages if Record['peak_rss_mb'] is not None]
+        return max(Peaks) if Peaks else None
+
+    def process_peak_rss_mb(self):
+        """Peak RSS of the process when the last stage ended, where stages have no peak of their own, MB."""
+        Peaks = [Record['process_peak_rss_mb'] for Record in self.Stages if Record['process_peak_rss_mb'] is not None]
+        return max(Peaks) if Peaks else None
+
+    def to_dict(self):
+        return {'file': self.FilePath and os.path.basename(self.FilePath),
+                'wall_s': round(time.perf_counter() - self.tic, 6),
+                'cpu_s': round(time.process_time() - self.cpu, 6),
+                'rss_start_mb': _mb(self.Rss),
+                'peak_rss_mb': self.peak_rss_mb(),
+                'process_peak_rss_mb': self.process_peak_rss_mb(),
+                'stages': self.Stages}
+
+    def write(self, Path):
+        """Write the metrics as JSON. Returns the path."""
+        with open(Path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=1)
+        return Path
+
+
+def print_stage(Record):
+    # A hook for the console: one line per finished stage
+    Counts = ', '.join(f'{Key} {Value}' for Key, Value in Record.items()
+                       if Key not in ('stage', 'wall_s', 'cpu_s', 'rss_start_mb', 'rss_end_mb', 'peak_rss_mb',
+                                      'process_peak_rss_mb'))
+    print(f'  {Record["stage"]}: {Record["wall_s"]:.2f} s' + (f' ({Counts})' if Counts else ''))
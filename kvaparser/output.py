@@ -0,0 +1,164 @@
+# Renaming of the markers to the short notation and output of the processed tracking.
+#
+# Two output formats:
+#   csv  <name>_Tracking.csv, free-text header, the calibration lines (if manual) and the marker data rounded to 4 digits
+#   npy  <name>_Tracking.npy, the full-precision float64 frames x (Time, X, Y...) matrix, readable memory-mapped with
+#        np.load(mmap_mode='r'), and <name>_Tracking.json with the metadata (see read_tracking)
+
+import json
+import os
+
+import numpy as np
+
+from kvaparser.filtering import describe_segments
+from kvaparser.metrics import RunMetrics
+
+FORMATS = ('csv', 'npy')
+
+def short_names(nMarkers):
+    """D1, P1, D2, P2... for any number of markers, the order expected by "Analyze - 1 - merge data.py"."""
+    return [('D' if imark % 2 == 0 else 'P') + str(imark // 2 + 1) for imark in range(nMarkers)]
+
+
+def short_columns(nMarkers):
+    # D1_X, D1_Y, P1_X...
+    return [MarkName + Axis for MarkName in short_names(nMarkers) for Axis in ('_X', '_Y')]
+
+
+def rename_markers(MarkerDataAllF, MarkerOrder=None):
+    """Rename the marker columns to D1, P1, D2... and re-order them if necessary.
+
+    MarkerOrder gives the short names repeating the current markers order (e.g. ['P2', 'D1', ...]); if empty, the
+    markers are assumed to already go in the target order. Returns the renamed data, the original and the new columns.
+    """
+    OldCols = MarkerDataAllF.columns[1:].to_list()
+    ncols = len(OldCols)
+    MarkerDataAllF = MarkerDataAllF.copy()
+    Target = short_columns((ncols + 1) // 2)[:ncols]
+    if not MarkerOrder:
+        strNew = Target
+        MarkerDataAllF.columns = ['Time'] + strNew
+        return MarkerDataAllF, OldCols, strNew
+
+    if isinstance(MarkerOrder, str):
+        MarkerOrder = MarkerOrder.split(',')
+    if not (len(MarkerOrder) * 2 == ncols):
+        raise ValueError('Number of columns to re-sort does not match the original number of columns.')
+    strNew = []
+    for MarkName in MarkerOrder:
+        strNew.append(MarkName + '_X')
+        strNew.append(MarkName + '_Y')
+    MarkerDataAllF.columns = ['Time'] + strNew
+    MarkerDataAllF = MarkerDataAllF[['Time'] + Target]
+    return MarkerDataAllF, OldCols, strNew
+
+
+def write_csv(Tracking, OutPath):
+    """Output the data into a CSV file: a free-text header, the calibration lines (if manual) and the marker data."""
+    # Round the data to reduce file size with minimal space sacrifice.
+    MarkerDataAllF = Tracking.MarkerDataAllF.round(4)
+    LineDataAll = Tracking.LineDataAll.copy()
+    for col in LineDataAll.columns:
+        if (col == "Name") | (col == "Units"):
+            continue
+        LineDataAll.loc[:, col] = round(LineDataAll.loc[:, col], 2)
+
+    with open(OutPath, 'w') as OutFile:
+        OutFile.write(Tracking.FileName + ' Kinovea tracking processed\n')
+        OutFile.write(f'{Tracking.FPSText or format(Tracking.FPS, ".17g")} fps\n')
+        OutFile.write(str(Tracking.ImX) + ' x ' + str(Tracking.ImY) + ' px\n')
+        if not (Tracking.CalPx2Unit == 1) and Tracking.LineCal:
+            OutFile.write(f'Calibration was mixed: markers mapped to the line(s) below were calibrated by them, the other markers by the factor {Tracking.CalPx2Unit} {Tracking.Units}/px applied in Kinovea. Line coordinates normalized, origin bottom-left, XY like in school.\n')
+            LineDataAll.to_csv(OutFile, index=False, header=True)
+        elif not (Tracking.CalPx2Unit == 1):
+            OutFile.write(f'Automatic calibration with factor {Tracking.CalPx2Unit} {Tracking.Units}/px was applied in Kinovea to all the markers. Origin and axes directions are arbitrary. The marker data follow.\n')
+            OutFile.write(f'Note the data have arbitrary origin and r.f. orientation. The analysis is expected to only compute Prox2Dist distance and extract 1st principal component from 4 coordinates of each pair of markers.\n')
+        else:
+            OutFile.write(f'Calibration was manual via {len(Tracking.LineCal)} line(s), details below, line coordinates normalized (marker coordinates will be calibrated though), origin bottom-left, XY like in school.\n')
+            LineDataAll.to_csv(OutFile, index=False, header=True)
+        Gaps = describe_segments(Tracking.Segments)
+        if Tracking.ResidualTable is None:
+            OutFile.write(f'The data were filtered with zero-lag second-order Butterworth low-pass filter at cutoff frequency {Tracking.fcut} Hz.'
+                          + (' ' + Gaps if Gaps else '') + '\n')
+        else:
+            Cutoffs = ', '.join(f'{col} {fc:g}' for col, fc in zip(Tracking.OldCols, Tracking.fcut))
+            OutFile.write(f'The data were filtered with zero-lag second-order Butterworth low-pass filter at cutoff frequencies chosen per marker coordinate by residual analysis (Winter): {Cutoffs} Hz.'
+                          + (' ' + Gaps if Gaps else '') + '\n')
+            OutFile.write('Residuals (RMS of raw minus filtered data, in marker data units) at each cutoff frequency follow.\n')
+            Tracking.ResidualTable.round(6).to_csv(OutFile, index=False, header=True)
+        OutFile.write(f'Original marker order was {Tracking.OldCols}\n.')
+        OutFile.write(f'They were abbreviated as {Tracking.NewCols} and probably re-ordered. Verify that these abbreviations match the originals.\n')
+        if Tracking.KinematicCols:
+            OutFile.write(f'After the markers, columns {Tracking.KinematicCols} give for each pair the distance between its markers (Dist) and the projection of its 4 coordinates on their 1st principal component (PC1), each followed by its first (_V, per s) and second (_A, per s2) derivatives.\n')
+        OutFile.write(f'Marker data are calibrated to {Tracking.Units}\n.')
+        MarkerDataAllF.to_csv(OutFile, index=False, header=True)
+    return OutPath
+
+
+def tracking_metadata(Tracking):
+    """Everything the CSV header says about the data, as a JSON-serializable dict."""
+    Cutoff = float(Tracking.fcut) if np.ndim(Tracking.fcut) == 0 else \
+        dict(zip(Tracking.OldCols, np.asarray(Tracking.fcut, dtype=float).tolist()))
+    Residuals = None
+    if Tracking.ResidualTable is not None:
+        Residuals = {col: Tracking.ResidualTable[col].tolist() for col in Tracking.ResidualTable.columns}
+    return {
+        'file': Tracking.FileName,
+        'fps': float(Tracking.FPS),
+        'image_size': [int(Tracking.ImX), int(Tracking.ImY)],
+        'columns': ['Time'] + list(Tracking.MarkerDataAllF.columns[1:]),
+        'original_columns': Tracking.OldCols,
+        # Short name of each marker coordinate -> original one, before re-ordering
+        'marker_names': dict(zip(Tracking.NewCols, Tracking.OldCols)),
+        'units': Tracking.Units,
+        'calibration': {
+            'kinovea_factor': float(Tracking.CalPx2Unit),
+            'manual': bool(Tracking.LineCal),
+            'line_factors': [float(Cal) for Cal in Tracking.LineCal],
+        },
+        'lines': json.loads(Tracking.LineDataAll.to_json(orient='records')),
+        'cutoff': Cutoff,
+        'residuals': Residuals,
+        'kinematic_columns': Tracking.KinematicCols or [],
+        'segments': [{'start': Seg.Start, 'stop': Seg.Stop, 'short': Seg.Short} for Seg in Tracking.Segments],
+    }
+
+
+def write_npy(Tracking, OutBase):
+    """Full-precision marker matrix as .npy and the metadata as .json. Returns the .npy path."""
+    Data = Tracking.MarkerDataAllF.to_numpy(dtype=np.float64)
+    np.save(OutBase + '.npy', Data)
+    Meta = tracking_metadata(Tracking)
+    Meta['shape'] = list(Data.shape)
+    Meta['dtype'] = str(Data.dtype)
+    with open(OutBase + '.json', 'w') as file:
+        json.dump(Meta, file, indent=1)
+    return OutBase + '.npy'
+
+
+def read_tracking(OutBase, mmap=True):
+    """Load the output of write_npy. Returns the frames x columns array (memory-mapped by default) and the metadata."""
+    if OutBase.endswith('.npy'):
+        OutBase = OutBase[:-4]
+    with open(OutBase + '.json', 'r') as file:
+        Meta = json.load(file)
+    return np.load(OutBase + '.npy', mmap_mode='r' if mmap else None), Meta
+
+
+def write_output(Tracking, OutBase, formats=('csv',)):
+    """Write the tracking in each of the formats to OutBase + extension. Returns the written paths.
+
+    Each format is recorded as a write_<format> stage in the Metrics of the Tracking, if any.
+    """
+    Metrics = Tracking.Metrics or RunMetrics()
+    Paths = []
+    for Format in formats:
+        if Format not in FORMATS:
+            raise ValueError(f'Unknown output format {Format}, expected one of {FORMATS}')
+        with Metrics.stage('write_' + Format, rows=len(Tracking.MarkerDataAllF)) as Stage:
+            if Format == 'csv':
+                Paths.append(write_csv(Tracking, OutBase + '.csv'))
+            elif Format == 'npy':
+                Paths.append(write_npy(Tracking, OutBase))
+            Stage.update(bytes=os.path.getsize(Paths[-1]))
+    return Paths
@@ -0,0 +1,371 @@
+# Streaming parser for Kinovea annotation (.kva) files.
+#
+# The file is read once, line by line in binary mode, so memory does not grow with the file size and the progress
+# bar can report bytes instead of lines (which would require a separate pass to count them).
+# Each line is dispatched on its leading tag with a single `startswith` chain, with the TrackPoint test first as it
+# accounts for nearly all the lines of a tracked video.
+# pandas (for the table of lines) and tqdm (for the progress bar) are only imported when needed, so reading the header
+# of a file (see read_header) is quick to start.
+# A large file can also be parsed by Track block in a process pool (parse_kva with workers): the blocks are found with
+# a plain search over the memory-mapped file (see index_blocks), each worker maps the file and parses its blocks, and
+# the tracks are put back in file order, so the result is the same as the sequential parse.
+
+import io
+import mmap
+import os
+import re
+from array import array
+from collections import namedtuple
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+# Bump when the parse result changes for the same file, to invalidate cached results (see kvaparser.cache)
+PARSER_VERSION = 6
+# Progress bar is refreshed every PROGRESS_STEP bytes rather than every line
+PROGRESS_STEP = 1 << 20
+
+_reName = re.compile(rb'name="([^"]*)"')
+# UserX, UserY, UserTime and the timestamp of the "x;y;timestamp" text, None if the text has no timestamp field
+_reTrackPoint = re.compile(rb'UserX="([^"]*)"[^>]*?UserY="([^"]*)"[^>]*?UserTime="([^"]*)"(?:[^>]*>[^;<]*;[^;<]*;([^;<]*)<)?')
+_reValue = re.compile(rb'>([^<]*)<')
+_reBlock = re.compile(rb'<(Track|Line) id="([^"]*)"')
+_reCount = re.compile(rb'<TrackPointList Count="(\d+)"')
+
+# A Track or Line block of a .kva file, Buffer[Start:Stop]
+Block = namedtuple('Block', ['Kind', 'Id', 'Start', 'Stop'])
+
+
+@dataclass
+class TrackData:
+    # One marker's trajectory, as typed columns rather than a row per point
+    Name: str
+    X: np.ndarray
+    Y: np.ndarray
+    Time: np.ndarray
+    # Video timestamp of each point (the TimePosition of the track plus the timestamp of the point, relative to it),
+    # None if some point has none
+    Tick: np.ndarray = None
+
+
+@dataclass
+class KvaData:
+    FileName: str
+    ImX: int = 0
+    ImY: int = 0
+    FPS: float = 0.
+    FPSText: str = '' # CaptureFramerate as written in the file, for the output header
+    MarkerNames: list = field(default_factory=list)
+    Tracks: list = field(default_factory=list)
+    LineNames: list = field(default_factory=list)
+    LineDataAll: 'pandas.DataFrame' = None
+    # Kinovea global calibration. A factor of 1 means no pre-calibrated line, coordinates are in pixels
+    CalPx2Unit: float = 1.
+    Units: str = 'px'
+    # Timestamps of the first frame and per frame, 0 if unknown: frames then come from the rounded times
+    FirstTimeStamp: int = 0
+    TimeStampsPerFrame: float = 0.
+
+
+def _tag_value(line):
+    return _reValue.search(line).group(1).decode()
+
+
+def _xy(line):
+    # "<Start>100;200</Start>" -> (100., 200.)
+    X, Y = _tag_value(line).split(';')[:2]
+    return float(X), float(Y)
+
+
+def _name(line):
+    return _reName.search(line).group(1).decode('utf-8')
+
+
+def decode_times(Tstr):
+    """Convert an array of Kinovea time strings (bytes) to seconds in one vectorized pass.
+
+    Accepts seconds ("12.35"), minutes and seconds ("1:02.35") and hours, minutes and seconds ("1:02:03.35"), also
+    mixed within the same array, and negative times ("-0:01.50", before a time origin set in Kinovea).
+    """
+    Tstr = np.asarray(Tstr, dtype=bytes)
+    # The sign applies to the whole time, not to its leading field (-0:01.50 is -1.5 s)
+    Negative = np.char.startswith(Tstr, b'-')
+    Tstr = np.char.lstrip(Tstr, b'-')
+    T = np.zeros(len(Tstr))
+    Ncolon = np.char.count(Tstr, b':')
+    for ncol in np.unique(Ncolon):
+        Sel = Ncolon == ncol
+        Rest = Tstr[Sel]
+        Tsel = np.zeros(len(Rest))
+        # Peel off the leading hours, then minutes, field
+        for _ in range(ncol):
+            Parts = np.char.partition(Rest, b':')
+            Tsel = (Tsel + Parts[:, 0].astype(float)) * 60
+            Rest = Parts[:, 2]
+        T[Sel] = Tsel + Rest.astype(float)
+    T[Negative] = -T[Negative]
+    return T
+
+
+def decode_ticks(Tstr):
+    """Convert an array of Kinovea timestamps (bytes) to integers, None if some of them are missing or invalid."""
+    try:
+        return np.asarray(Tstr, dtype=bytes).astype(np.int64)
+    except ValueError:
+        return None
+
+
+def _close_track(Name, X, Y, TimeBuf, TickBuf, TrackStart):
+    Tick = decode_ticks(bytes(TickBuf).split())
+    return TrackData(Name=Name,
+                     X=np.frombuffer(X, dtype=np.float64),
+                     Y=np.frombuffer(Y, dtype=np.float64),
+                     Time=decode_times(bytes(TimeBuf).split()),
+                     Tick=None if Tick is None else Tick + TrackStart)
+
+
+def _parse_lines(Lines, Kva, pbar=None):
+    # Core of the parser: fill Kva from an iterable of byte lines. Returns the rows of the line table.
+    LineData = []
+    LUnit = Lpx = CalX1 = CalY1 = None
+    MarkName = LineName = None
+    TrackStart = 0
+    # Coordinates of the current marker are appended to typed arrays, time strings and timestamps to space-separated
+    # buffers ('-' for a missing timestamp)
+    X, Y, TimeBuf, TickBuf = array('d'), array('d'), bytearray(), bytearray()
+    LineX1 = LineY1 = None
+    flag_activeMark = flag_activeLine = flag_activeCal = False
+
+    nbytes = 0
+    for line in Lines:
+        nbytes += len(line)
+        if nbytes >= PROGRESS_STEP and pbar is not None:
+            pbar.update(nbytes)
+            nbytes = 0
+        line = line.lstrip()
+
+        # Marker coordinates
+        if line.startswith(b'<TrackPoint '):
+            if flag_activeMark:
+                Xs, Ys, Tstr, Tick = _reTrackPoint.search(line).groups()
+                X.append(float(Xs))
+                Y.append(float(Ys))
+                TimeBuf += Tstr
+                TimeBuf += b' '
+                TickBuf += Tick or b'-'
+                TickBuf += b' '
+            continue
+
+        # Marker name, then wrap up the marker's data
+        if line.startswith(b'<Track '):
+            MarkName = _name(line)
+            Kva.MarkerNames.append(MarkName)
+            TrackStart = 0
+            flag_activeMark = True
+        elif flag_activeMark and line.startswith(b'<TimePosition>'):
+            # Timestamp the points of the track are relative to
+            TrackStart = int(_tag_value(line))
+        elif line.startswith(b'</TrackPointList'):
+            if flag_activeMark:
+                Kva.Tracks.append(_close_track(MarkName, X, Y, TimeBuf, TickBuf, TrackStart))
+                # Ready to be filled in by the next marker
+                X, Y, TimeBuf, TickBuf = array('d'), array('d'), bytearray(), bytearray()
+            flag_activeMark = False
+
+        # Drawn lines, if any
+        elif line.startswith(b'<Line '):
+            LineName = _name(line)
+            Kva.LineNames.append(LineName)
+            flag_activeLine = True
+        elif flag_activeLine and line.startswith(b'<Start>'):
+            LineX1, LineY1 = _xy(line)
+        elif flag_activeLine and line.startswith(b'<End>'):
+            LineX2, LineY2 = _xy(line)
+            LineData.append({'Name': LineName,
+                             'Pixel L': np.sqrt((LineX1 - LineX2)**2 + (LineY1 - LineY2)**2),
+                             'Center_X': (LineX1 + LineX2) / 2,
+                             'Center_Y': (LineY1 + LineY2) / 2})
+        elif line.startswith(b'</Line>'):
+            flag_activeLine = False
+
+        # Calibration, if any
+        elif line.startswith(b'<Calibration>'):
+            flag_activeCal = True
+        elif line.startswith(b'</Calibration>'):
+            flag_activeCal = False
+        elif flag_activeCal and line.startswith(b'<Length>'):
+            LUnit = float(_tag_value(line))
+        elif flag_activeCal and line.startswith(b'<A>'):
+            CalX1, CalY1 = _xy(line)
+        elif flag_activeCal and line.startswith(b'<B>'):
+            CalX2, CalY2 = _xy(line)
+            Lpx = np.sqrt((CalX1 - CalX2)**2 + (CalY1 - CalY2)**2)
+        elif flag_activeCal and line.startswith(b'<Unit '):
+            Kva.Units = _tag_value(line)
+            if LUnit is not None and Lpx:
+                Kva.CalPx2Unit = round(LUnit / Lpx, 4)
+
+        # Basic properties of the video
+        elif line.startswith(b'<ImageSize>'):
+            ImX, ImY = _tag_value(line).split(';')
+            Kva.ImX, Kva.ImY = int(ImX), int(ImY)
+        elif line.startswith(b'<CaptureFramerate>'):
+            Kva.FPSText = _tag_value(line)
+            Kva.FPS = float(Kva.FPSText)
+        elif line.startswith(b'<AverageTimeStampsPerFrame>'):
+            Kva.TimeStampsPerFrame = float(_tag_value(line))
+        elif line.startswith(b'<FirstTimeStamp>'):
+            Kva.FirstTimeStamp = int(_tag_value(line))
+    if pbar is not None:
+        pbar.update(nbytes)
+    return LineData
+
+
+def _line_table(LineData):
+    import pandas as pd
+    return pd.DataFrame(LineData, columns=['Name', 'Pixel L', 'Center_X', 'Center_Y'])
+
+
+def check_header(Kva):
+    if Kva.FPS <= 0 or Kva.ImX <= 0:
+        raise ValueError(f'{Kva.FileName} has no ImageSize or CaptureFramerate, is it a Kinovea annotation file?')
+
+
+def parse_kva(FilePath, progress=True, workers=None):
+    """Parse a .kva file in a single pass.
+
+    Returns a KvaData with the video properties, marker trajectories (one TrackData per marker, see align_tracks to
+    put them on a common time base), drawn lines and the Kinovea calibration, if any. With workers > 1, the Track
+    blocks are parsed in that many processes, with the same result.
+    """
+    if workers and workers > 1:
+        Kva = _parse_parallel(FilePath, workers, progress)
+        if Kva is not None:
+            return Kva
+    from tqdm import tqdm
+    Kva = KvaData(FileName=os.path.basename(FilePath))
+    FileSize = os.path.getsize(FilePath)
+    with open(FilePath, 'rb') as file, tqdm(total=FileSize, desc='Parsing', unit='B', unit_scale=True,
+                                            unit_divisor=1024, ncols=75, disable=not progress) as pbar:
+        LineData = _parse_lines(file, Kva, pbar)
+    check_header(Kva)
+    Kva.LineDataAll = _line_table(LineData)
+    return Kva
+
+
+def _read_header(Buffer, Kva):
+    # Parse all of Buffer but the contents of its Track blocks into Kva. Returns the rows of the line table and the
+    # Track blocks.
+    Parts, TrackBlocks = [], []
+    Pos = 0
+    for Block in index_blocks(Buffer):
+        if Block.Kind == 'Track':
+            # Keep the <Track id=... name=...> opening for the marker name
+            Parts.append(Buffer[Pos:Buffer.find(b'>', Block.Start) + 1] + b'\n')
+            Pos = Block.Stop
+            TrackBlocks.append(Block)
+    Parts.append(Buffer[Pos:])
+    return _parse_lines(b''.join(Parts).splitlines(True), Kva), TrackBlocks
+
+
+def track_summary(Buffer, Block):
+    """Number of points and first and last times (s) of a Track block, NaN times if it has no points.
+
+    The count is the Count attribute of the TrackPointList (the points are counted if it is missing), the times come
+    from the first and the last TrackPoint only.
+    """
+    First = Buffer.find(b'<TrackPoint ', Block.Start, Block.Stop)
+    if First < 0:
+        return 0, np.nan, np.nan
+    Last = Buffer.rfind(b'<TrackPoint ', Block.Start, Block.Stop)
+    Count = _reCount.search(Buffer[Block.Start:First])
+    Count = int(Count.group(1)) if Count else bytes(Buffer[First:Block.Stop]).count(b'<TrackPoint ')
+    Times = [_reTrackPoint.search(Buffer[Pos:Buffer.find(b'>', Pos) + 1]).group(3) for Pos in (First, Last)]
+    Start, Stop = decode_times(Times)
+    return Count, float(Start), float(Stop)
+
+
+def read_header(FilePath):
+    """Video properties, Kinovea calibration, drawn lines and marker names of a .kva file, without the track points.
+
+    The contents of the Track blocks are skipped with a plain search over the memory-mapped file, so only a small part
+    of it is actually parsed. Returns a KvaData with no Tracks.
+    """
+    Kva = KvaData(FileName=os.path.basename(FilePath))
+    LineData = []
+    if os.path.getsize(FilePath) > 0:
+        with open(FilePath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as Buffer:
+            LineData, _ = _read_header(Buffer, Kva)
+    check_header(Kva)
+    Kva.LineDataAll = _line_table(LineData)
+    return Kva
+
+
+def parse_block(Buffer, FileName=''):
+    """Parse a part of a .kva file held in memory, e.g. a single Track or Line block. No header is required."""
+    Kva = KvaData(FileName=FileName)
+    Kva.LineDataAll = _line_table(_parse_lines(Buffer.splitlines(True), Kva))
+    return Kva
+
+
+def _parse_track(FilePath, Start, Stop):
+    # Worker of _parse_parallel: the tracks of the Track block at Start:Stop of the file, None if it has points not
+    # closed by a </TrackPointList> (the sequential parse would carry them over to the next track)
+    with open(FilePath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as Buffer:
+        if Buffer.rfind(b'<TrackPoint ', Start, Stop) > Buffer.rfind(b'</TrackPointList', Start, Stop):
+            return None
+        Kva = KvaData(FileName='')
+        _parse_lines(io.BytesIO(Buffer[Start:Stop]), Kva)
+    return Kva.Tracks
+
+
+def _parse_parallel(FilePath, workers, progress):
+    # parse_kva with the Track blocks parsed in a process pool. Returns None if the file cannot be split into blocks
+    # parsed independently, to parse it sequentially instead.
+    from concurrent.futures import ProcessPoolExecutor
+    from tqdm import tqdm
+    Kva = KvaData(FileName=os.path.basename(FilePath))
+    FileSize = os.path.getsize(FilePath)
+    if FileSize == 0:
+        return None
+    with open(FilePath, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as Buffer:
+        LineData, TrackBlocks = _read_header(Buffer, Kva)
+    # Track points outside the indexed blocks, or nothing to share
+    if Kva.Tracks or len(TrackBlocks) < 2:
+        return None
+    with tqdm(total=FileSize, desc='Parsing', unit='B', unit_scale=True, unit_divisor=1024, ncols=75,
+              disable=not progress) as pbar, \
+            ProcessPoolExecutor(max_workers=min(workers, len(TrackBlocks))) as pool:
+        pbar.update(FileSize - sum(Block.Stop - Block.Start for Block in TrackBlocks))
+        Futures = [pool.submit(_parse_track, FilePath, Block.Start, Block.Stop) for Block in TrackBlocks]
+        # In file order, as the markers
+        for Future, Block in zip(Futures, TrackBlocks):
+            Tracks = Future.result()
+            if Tracks is None:
+                pool.shutdown(cancel_futures=True)
+                return None
+            Kva.Tracks += Tracks
+            pbar.update(Block.Stop - Block.Start)
+    check_header(Kva)
+    Kva.LineDataAll = _line_table(LineData)
+    return Kva
+
+
+def index_blocks(Buffer):
+    """Byte offsets of the <Track id=...>...</Track> and <Line id=...>...</Line> blocks of a .kva file, in file order.
+
+    Only the block openings are searched with a regular expression, their contents are skipped with a plain find.
+    """
+    Blocks = []
+    Pos = 0
+    while True:
+        Match = _reBlock.search(Buffer, Pos)
+        if Match is None:
+            return Blocks
+        Kind = Match.group(1)
+        End = Buffer.find(b'</' + Kind + b'>', Match.end())
+        if End < 0:
+            raise ValueError(f'Unterminated <{Kind.decode()}> block at byte {Match.start()}')
+        Pos = End + len(Kind) + 3
+        Blocks.append(Block(Kind.decode(), Match.group(2).decode('utf-8'), Match.start(), Pos))
@@ -0,0 +1,194 @@
+# Non-interactive processing of a .kva file: parse, align, normalize, calibrate, filter, rename and write.
+#
+# The answers the interactive script asks for in the CMD session come from a config dict instead, with the same
+# defaults as pressing Enter at every prompt:
+#   line_lengths              line name -> true length with units, e.g. {"Line_1": "10 mm"}
+#   line_markers              line name -> the markers it calibrates, e.g. {"Line_1": ["Dist_1", "Prox_1"]}; any number
+#                             of markers per line, [] for a line calibrating none. With a Kinovea calibration, the
+#                             markers of no line keep it
+#   source_origins            line name (or "kinovea") -> origin of its markers in normalized video coordinates,
+#                             bottom-left, e.g. {"Line_2": [0.5, 0]} for a camera composed in the right half
+#   allow_global_calibration  apply the Kinovea calibration to more than 2 markers (the "Y" answer)
+#   cutoff                    filter cutoff frequency, Hz, or "auto" to choose one per channel by residual analysis
+#   cutoff_grid               cutoffs tried by the residual analysis, Hz, 0.5 Hz steps up to 20 Hz if empty
+#   workers                   processes sharing the residual analysis, none if empty
+#   parse_workers             processes parsing the tracks of the file, one per Track block at most, none if empty
+#   kinematics                add the distance and first principal component of each pair, with their derivatives,
+#                             to the output (see kvaparser.kinematics)
+#   marker_order              short names repeating the current markers order, e.g. ["P2", "D2", "D1", "P1"]
+#   output_dir                where the _Tracking outputs go, next to the .kva file if empty
+#   formats                   output formats, "csv" and/or "npy" (see kvaparser.output)
+#   cache                     keep parse results on disk, so re-running a file skips the parsing (see kvaparser.cache);
+#                             off by default in batch mode
+#   cache_dir, cache_size_mb  where the cache is and how large it may grow, ~/.cache/kvaparser and 2 GB if empty
+#   metrics                   write the time, memory and item counts of each stage to <name>_Tracking.metrics.json
+# A per-file sidecar <name>.kva.json, if present, overrides the config for that file.
+
+import copy
+import json
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from kvaparser.parse import parse_kva
+from kvaparser.cache import DEFAULT_CACHE_SIZE_MB, parse_kva_cached
+from kvaparser.align import align_tracks, frame_index
+from kvaparser.metrics import RunMetrics
+from kvaparser.calibration import normalize, calibrate, denormalize
+from kvaparser.kinematics import pair_kinematics
+from kvaparser.filtering import DEFAULT_CUTOFF, check_continuity, filter_markers, auto_cutoff
+from kvaparser.output import rename_markers, write_output
+
+DEFAULT_CONFIG = {
+    'line_lengths': {},
+    'line_markers': {},
+    'source_origins': {},
+    'allow_global_calibration': False,
+    'cutoff': DEFAULT_CUTOFF,
+    'marker_order': None,
+    'output_dir': None,
+    'formats': ['csv'],
+    'cache': True,
+    'cache_dir': None,
+    'cache_size_mb': DEFAULT_CACHE_SIZE_MB,
+    'cutoff_grid': None,
+    'workers': None,
+    'parse_workers': None,
+    'metrics': True,
+    'kinematics': False,
+}
+
+
+@dataclass
+class Tracking:
+    # Everything the output writers need about a processed file
+    FileName: str
+    FPS: float
+    ImX: int
+    ImY: int
+    CalPx2Unit: float
+    Units: str
+    LineDataAll: 'pandas.DataFrame'
+    LineCal: list
+    fcut: object # a single cutoff, Hz, or one per marker column when chosen by residual analysis
+    OldCols: list
+    NewCols: list
+    MarkerDataAllF: 'pandas.DataFrame'
+    Continuous: bool
+    Segments: list
+    ResidualTable: 'pandas.DataFrame' = None
+    Metrics: RunMetrics = None # stages run so far, the output writers add theirs
+    KinematicCols: list = None # columns appended to the marker data by the kinematics stage, if run
+    FPSText: str = '' # frame rate as written in the .kva file, FPS in full precision if empty
+
+
+def load_config(ConfigPath=None, FilePath=None, Defaults=None):
+    """Defaults (DEFAULT_CONFIG if empty), updated with the config file, then with the sidecar <FilePath>.json if it
+    exists."""
+    Config = copy.deepcopy(DEFAULT_CONFIG if Defaults is None else Defaults)
+    for Path in (ConfigPath, None if FilePath is None else FilePath + '.json'):
+        if Path and os.path.isfile(Path):
+            with open(Path, 'r') as file:
+                Config.update(json.load(file))
+    return Config
+
+
+def is_auto(fcut):
+    return isinstance(fcut, str) and fcut.strip().lower() == 'auto'
+
+
+def load_kva_file(FilePath, Config=None, progress=False, Metrics=None):
+    """Parse a .kva file, through the parse cache unless disabled in the config."""
+    Config = dict(copy.deepcopy(DEFAULT_CONFIG), **(Config or {}))
+    Metrics = Metrics or RunMetrics(FilePath)
+    with Metrics.stage('parse', bytes=os.path.getsize(FilePath)) as Stage:
+        if Config['cache']:
+            Kva = parse_kva_cached(FilePath, Config['cache_dir'], Config['cache_size_mb'], progress=progress,
+                                   Info=Stage, workers=Config['parse_workers'])
+        else:
+            Kva = parse_kva(FilePath, progress=progress, workers=Config['parse_workers'])
+        Stage.update(markers=len(Kva.MarkerNames), points=sum(len(Track.Time) for Track in Kva.Tracks),
+                     lines=len(Kva.LineNames))
+    return Kva
+
+
+def process_kva(Kva, Config=None, Metrics=None):
+    """Run all the stages after parsing. Raises ValueError when the file cannot be processed with this config.
+
+    The stages are recorded in Metrics (a new RunMetrics if not given), available as the Metrics of the Tracking.
+    """
+    Config = dict(copy.deepcopy(DEFAULT_CONFIG), **(Config or {}))
+    Metrics = Metrics or RunMetrics(Kva.FileName)
+    with Metrics.stage('align') as Stage:
+        Table = align_tracks(Kva.Tracks, Kva.FPS, Kva.FirstTimeStamp, Kva.TimeStampsPerFrame)
+        MarkerDataAll = Table.to_frame()
+        # Runs of skipped frames, and points of the other markers missing on the frames of the first one
+        Stage.update(markers=len(Kva.Tracks), frames=len(Table.Frame), frames_from=Table.FrameSource,
+                     gaps=int(np.count_nonzero(np.diff(Table.Frame) > 1)),
+                     missing=int(np.count_nonzero(np.isnan(Table.Data))) // 2)
+    with Metrics.stage('normalize', columns=MarkerDataAll.shape[1] - 1):
+        MarkerDataAll, LineDataAll = normalize(MarkerDataAll, Kva.LineDataAll, Kva.ImX, Kva.ImY)
+    with Metrics.stage('calibrate', lines=len(LineDataAll)):
+        MarkerDataAll, LineDataAll, LineCal, Units = calibrate(
+            MarkerDataAll, LineDataAll, Kva.MarkerNames, Kva.CalPx2Unit, Kva.Units,
+            LineLengths=Config['line_lengths'], LineMarkers=Config['line_markers'],
+            AllowGlobalCalibration=Config['allow_global_calibration'], Origins=Config['source_origins'])
+    Continuous = check_continuity(frame_index(MarkerDataAll, Kva.FPS) / Kva.FPS)
+    fcut = Config['cutoff']
+    ResidualTable = None
+    if is_auto(fcut):
+        with Metrics.stage('residual_analysis') as Stage:
+            fcut, ResidualTable = auto_cutoff(MarkerDataAll, Kva.FPS, Config['cutoff_grid'], Config['workers'])
+            # Residuals in the units of the marker data
+            ResidualTable = denormalize(ResidualTable, Kva.ImX, Kva.ImY)
+            Stage.update(cutoffs=len(ResidualTable))
+    with Metrics.stage('filter') as Stage:
+        MarkerDataAllF, Segments = filter_markers(MarkerDataAll, fcut, Kva.FPS)
+        Stage.update(segments=len(Segments), short_segments=sum(1 for Seg in Segments if Seg.Short))
+    with Metrics.stage('rename'):
+        MarkerDataAllF, OldCols, NewCols = rename_markers(MarkerDataAllF, Config['marker_order'])
+        MarkerDataAllF = denormalize(MarkerDataAllF, Kva.ImX, Kva.ImY)
+    KinematicCols = None
+    if Config['kinematics']:
+        with Metrics.stage('kinematics') as Stage:
+            Kinematics = pair_kinematics(MarkerDataAllF, Kva.FPS)
+            MarkerDataAllF = MarkerDataAllF.join(Kinematics)
+            KinematicCols = list(Kinematics.columns)
+            Stage.update(columns=len(KinematicCols))
+    return Tracking(FileName=Kva.FileName, FPS=Kva.FPS, ImX=Kva.ImX, ImY=Kva.ImY, CalPx2Unit=Kva.CalPx2Unit,
+                    Units=Units, LineDataAll=LineDataAll, LineCal=LineCal, fcut=fcut, OldCols=OldCols,
+                    NewCols=NewCols, MarkerDataAllF=MarkerDataAllF, Continuous=Continuous,
+                    Segments=Segments, ResidualTable=ResidualTable, Metrics=Metrics, KinematicCols=KinematicCols,
+                    FPSText=Kva.FPSText)
+
+
+def output_base(FilePath, OutDir=None):
+    # <OutDir>/<name>.kva_Tracking, to be completed with the extension of each format
+    OutDir = OutDir or os.path.dirname(os.path.abspath(FilePath))
+    return os.path.join(OutDir, os.path.basename(FilePath) + '_Tracking')
+
+
+def write_tracking(Tracking, FilePath, Config):
+    """Write the _Tracking outputs of a processed file in the configured formats, then its metrics if enabled.
+
+    Returns the written paths.
+    """
+    OutBase = output_base(FilePath, Config['output_dir'])
+    OutPaths = write_output(Tracking, OutBase, Config['formats'])
+    if Config['metrics'] and Tracking.Metrics is not None:
+        OutPaths.append(Tracking.Metrics.write(OutBase + '.metrics.json'))
+    return OutPaths
+
+
+def process_file(FilePath, Config=None, progress=False, Metrics=None):
+    """Parse and process one .kva file and write its _Tracking outputs. Returns the Tracking and the output paths.
+
+    The metrics of the stages are in Tracking.Metrics (or in Metrics, if given, also when processing fails).
+    """
+    Config = dict(copy.deepcopy(DEFAULT_CONFIG), **(Config or {}))
+    Metrics = Metrics or RunMetrics(FilePath)
+    Kva = load_kva_file(FilePath, Config, progress=progress, Metrics=Metrics)
+    Tracking = process_kva(Kva, Config, Metrics)
+    OutPaths = write_tracking(Tracking, FilePath, Config)
+    return Tracking, OutPaths
@@ -0,0 +1,132 @@
+# Synthetic .kva files for benchmarks and for trying the processing without real recordings.
+#
+#   python -m kvaparser.synth out.kva --markers 6 --frames 100000 --fps 60 --lines 3 --colon --gaps 5
+#
+# Markers come in distal/proximal pairs (Dist_1, Prox_1, Dist_2...) moving smoothly with some tracking noise, with a
+# calibration line (Line_1, Line_2...) near each pair, laid out the way Kinovea writes its annotation files.
+
+import argparse
+import sys
+
+import numpy as np
+
+
+def format_time(T, colon=True, decimals=2):
+    """Kinovea-like time strings: seconds ("12.35"), or M:SS.ff / H:MM:SS.ff when colon is set."""
+    if not colon:
+        return [f'{t:.{decimals}f}' for t in T]
+    Width = decimals + 3
+    Strings = []
+    for t in T:
+        h, rest = divmod(t, 3600)
+        m, s = divmod(rest, 60)
+        if h:
+            Strings.append(f'{int(h)}:{int(m):02d}:{s:0{Width}.{decimals}f}')
+        else:
+            Strings.append(f'{int(m)}:{s:0{Width}.{decimals}f}')
+    return Strings
+
+
+def gap_frames(nFrames, nGaps, rng, MaxLength=5):
+    """Frames skipped by all the markers, as when the Kinovea time slider was moved too fast: nGaps runs of 1 to
+    MaxLength frames, away from the start and the end."""
+    Skipped = set()
+    if nGaps <= 0 or nFrames < 4 * MaxLength:
+        return Skipped
+    for Start in rng.choice(np.arange(MaxLength, nFrames - 2 * MaxLength), size=nGaps, replace=False):
+        Skipped.update(range(Start, Start + rng.integers(1, MaxLength + 1)))
+    return Skipped
+
+
+def write_kva(Path, markers=4, frames=1000, fps=60., lines=None, colon=True, gaps=0, calibration=None, seed=0,
+              ImX=1920, ImY=1080, late=0):
+    """Write a synthetic .kva file. Returns the number of track points written.
+
+    lines defaults to one per pair of markers, the last one for a single marker if their number is odd. calibration,
+    if given, is a Kinovea calibration factor (units/px) applied to all the markers, as with a calibrated line in
+    Kinovea. With late, all the markers but the first start tracking that many frames later; as in Kinovea, their
+    TimePosition is then the timestamp of their first frame and the timestamps of their points are relative to it.
+    """
+    rng = np.random.default_rng(seed)
+    nPairs = (markers + 1) // 2
+    lines = nPairs if lines is None else lines
+    decimals = 2 if fps <= 100 else 3
+    Skipped = gap_frames(frames, gaps, rng)
+    Frames = np.array([f for f in range(frames) if f not in Skipped], dtype=np.int64)
+    TimeStr = format_time(Frames / fps, colon, decimals)
+    CalPx2Unit = calibration or 1.
+
+    with open(Path, 'w', newline='\r\n') as file:
+        w = file.write
+        w('<?xml version="1.0" encoding="utf-8"?>\n<KinoveaVideoAnalysis>\n')
+        w('  <FormatVersion>2.0</FormatVersion>\n  <Producer>Kinovea.0.9.5.0</Producer>\n')
+        w('  <OriginalFilename>synthetic</OriginalFilename>\n')
+        w(f'  <ImageSize>{ImX};{ImY}</ImageSize>\n')
+        w('  <AverageTimeStampsPerFrame>1</AverageTimeStampsPerFrame>\n')
+        w(f'  <CaptureFramerate>{fps:g}</CaptureFramerate>\n  <UserFramerate>{fps:g}</UserFramerate>\n')
+        w('  <FirstTimeStamp>0</FirstTimeStamp>\n')
+        w('  <Calibration>\n    <CalibrationLine>\n')
+        w(f'      <Length>{100 * CalPx2Unit:g}</Length>\n      <A>0;0</A>\n      <B>100;0</B>\n')
+        w('    </CalibrationLine>\n')
+        w('    <Unit Abbreviation="mm">Millimeters</Unit>\n' if calibration else '    <Unit Abbreviation="px">Pixels</Unit>\n')
+        w('  </Calibration>\n')
+
+        w('  <Keyframes>\n    <Keyframe id="1">\n      <Position UserTime="0:00.00">0</Position>\n      <Drawings>\n')
+        for iline in range(lines):
+            X0, Y0 = (iline + 0.5) * ImX / max(lines, 1), ImY * 0.8
+            Length = rng.uniform(30, 60)
+            w(f'        <Line id="{iline + 1}" name="Line_{iline + 1}">\n')
+            w(f'          <Start>{X0:.0f};{Y0:.0f}</Start>\n          <End>{X0 + Length:.0f};{Y0 + 3:.0f}</End>\n')
+            w('          <DrawingStyle>\n            <Color Key="color">\n              <Value>255;255;0;0</Value>\n'
+              '            </Color>\n          </DrawingStyle>\n        </Line>\n')
+        w('      </Drawings>\n    </Keyframe>\n  </Keyframes>\n')
+
+        w('  <Tracks>\n')
+        T = Frames / fps
+        nPoints = 0
+        for imark in range(markers):
+            Name = ('Dist' if imark % 2 == 0 else 'Prox') + f'_{imark // 2 + 1}'
+            # Smooth movement around the pair's position, image coordinates centered on the frame, Y upwards
+            Phase = rng.uniform(0, 2 * np.pi)
+            X = (((imark // 2) + 0.5) / max(nPairs, 1) - 0.5) * ImX + 40 * (imark % 2) + \
+                60 * np.sin(2 * np.pi * 0.5 * T + Phase) + rng.normal(0, 0.5, len(T))
+            Y = 100 * np.cos(2 * np.pi * 0.3 * T + Phase) + rng.normal(0, 0.5, len(T))
+            X, Y = X * CalPx2Unit, Y * CalPx2Unit
+            Start = late if imark > 0 else 0
+            Tracked = Frames >= Start
+            nPoints += np.count_nonzero(Tracked)
+            w(f'    <Track id="{100 + imark}" name="{Name}">\n      <TimePosition>{Start}</TimePosition>\n')
+            w(f'      <TrackPointList Count="{np.count_nonzero(Tracked)}" '
+              f'UserUnitLength="{"mm" if calibration else "px"}">\n')
+            w(''.join(f'        <TrackPoint UserX="{x:.2f}" UserXInvariant="{x:.2f}" UserY="{y:.2f}" '
+                      f'UserYInvariant="{y:.2f}" UserTime="{t}">{x / CalPx2Unit + ImX / 2:.0f};'
+                      f'{ImY / 2 - y / CalPx2Unit:.0f};{f - Start}</TrackPoint>\n'
+                      for x, y, t, f in zip(X[Tracked], Y[Tracked], np.array(TimeStr)[Tracked], Frames[Tracked])))
+            w('      </TrackPointList>\n')
+            w('      <TrackerParameters>\n        <SearchWindow>40;40</SearchWindow>\n      </TrackerParameters>\n')
+            w('    </Track>\n')
+        w('  </Tracks>\n</KinoveaVideoAnalysis>\n')
+    return int(nPoints)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic Kinovea annotation (.kva) file.')
+    parser.add_argument('path')
+    parser.add_argument('--markers', type=int, default=4)
+    parser.add_argument('--frames', type=int, default=1000)
+    parser.add_argument('--fps', type=float, default=60.)
+    parser.add_argument('--lines', type=int, default=None, help='calibration lines, one per pair of markers by default')
+    parser.add_argument('--colon', action='store_true', help='M:SS.ff time strings instead of seconds')
+    parser.add_argument('--gaps', type=int, default=0, help='number of runs of skipped frames')
+    parser.add_argument('--calibration', type=float, default=None, help='Kinovea calibration factor, units/px')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--late', type=int, default=0, help='frames all the markers but the first start tracking later')
+    args = parser.parse_args(argv)
+    nPoints = write_kva(args.path, args.markers, args.frames, args.fps, args.lines, args.colon, args.gaps,
+                        args.calibration, args.seed, late=args.late)
+    print(f'{args.path}: {nPoints} track points')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
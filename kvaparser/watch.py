@@ -0,0 +1,132 @@
+# Watch mode: regenerate the output of .kva files every time they are saved, e.g. while fixing tracking in Kinovea.
+#
+#   python -m kvaparser.watch SESSION.kva (or SESSIONS_DIR) --config batch.json --interval 1
+#
+# On each save, the file is split into its <Track id=...> and <Line id=...> blocks (see parse.index_blocks) and only
+# the blocks whose content changed since the previous save are parsed again, the others are reused from memory. The
+# rest of the file (video properties and calibration) is small and parsed every time. Alignment, calibration and
+# filtering then run on the whole data, as they are vectorized and take a fraction of the parsing time.
+
+import argparse
+import hashlib
+import os
+import sys
+import time
+
+import pandas as pd
+
+from kvaparser.parse import check_header, index_blocks, parse_block
+from kvaparser.metrics import RunMetrics
+from kvaparser.pipeline import load_config, process_kva, write_tracking
+from kvaparser.batch import find_kva_files
+
+
+class IncrementalParser:
+    """Parses a .kva file again and again, re-parsing only the Track and Line blocks which changed."""
+
+    def __init__(self, FilePath):
+        self.FilePath = FilePath
+        self.Blocks = {} # content hash -> KvaData of the block
+        self.Ids = {} # (kind, id) -> content hash, as of the previous parse
+
+    def parse(self):
+        """Returns the KvaData of the whole file and the (kind, name) of the blocks parsed again."""
+        with open(self.FilePath, 'rb') as file:
+            Buffer = file.read()
+        Rest = bytearray()
+        Pos = 0
+        Blocks, Ids, Keys, Changed = {}, {}, [], []
+        for Block in index_blocks(Buffer):
+            Rest += Buffer[Pos:Block.Start]
+            Pos = Block.Stop
+            Content = Buffer[Block.Start:Block.Stop]
+            Key = hashlib.blake2b(Content, digest_size=16).digest()
+            if Key not in Blocks:
+                Blocks[Key] = self.Blocks[Key] if Key in self.Blocks else parse_block(Content)
+            if Key not in self.Blocks:
+                BlockKva = Blocks[Key]
+                Changed.append((Block.Kind, (BlockKva.MarkerNames + BlockKva.LineNames + [Block.Id])[0]))
+            Ids[(Block.Kind, Block.Id)] = Key
+            Keys.append(Key)
+        Rest += Buffer[Pos:]
+
+        # Video properties and calibration, then the blocks in file order
+        Kva = parse_block(bytes(Rest), FileName=os.path.basename(self.FilePath))
+        check_header(Kva)
+        LineTables = [Kva.LineDataAll]
+        for Key in Keys:
+            BlockKva = Blocks[Key]
+            Kva.MarkerNames += BlockKva.MarkerNames
+            Kva.Tracks += BlockKva.Tracks
+            Kva.LineNames += BlockKva.LineNames
+            LineTables.append(BlockKva.LineDataAll)
+        Kva.LineDataAll = pd.concat([Table for Table in LineTables if len(Table)] or [LineTables[0]],
+                                    ignore_index=True)
+        Removed = [Id for Id in self.Ids if Id not in Ids]
+        self.Blocks, self.Ids = Blocks, Ids
+        return Kva, Changed, Removed
+
+
+def watch(Paths, ConfigPath=None, Interval=1., Polls=None):
+    """Poll the .kva files found in Paths and regenerate the output of each one saved since the last poll.
+
+    A file is processed once its size and modification time held still for one poll, so a save in progress is not
+    read. Runs until interrupted, or for the given number of polls.
+    """
+    Parsers, Seen, Pending = {}, {}, {}
+    ipoll = 0
+    while Polls is None or ipoll < Polls:
+        ipoll += 1
+        for FilePath in find_kva_files(Paths):
+            try:
+                Stat = os.stat(FilePath)
+            except FileNotFoundError:
+                continue
+            Signature = (Stat.st_size, Stat.st_mtime_ns)
+            if Seen.get(FilePath) == Signature:
+                continue
+            if Pending.get(FilePath) != Signature:
+                Pending[FilePath] = Signature
+                continue
+            Seen[FilePath] = Signature
+            _update(FilePath, Parsers.setdefault(FilePath, IncrementalParser(FilePath)), ConfigPath)
+        if Polls is None or ipoll < Polls:
+            time.sleep(Interval)
+
+
+def _update(FilePath, Parser, ConfigPath):
+    tic = time.perf_counter()
+    Metrics = RunMetrics(FilePath)
+    try:
+        with Metrics.stage('parse', bytes=os.path.getsize(FilePath)) as Stage:
+            Kva, Changed, Removed = Parser.parse()
+            Stage.update(markers=len(Kva.MarkerNames), lines=len(Kva.LineNames), reparsed=len(Changed))
+        Config = load_config(ConfigPath, FilePath)
+        Tracking = process_kva(Kva, Config, Metrics)
+        OutPaths = write_tracking(Tracking, FilePath, Config)
+    except Exception as err:
+        print(f'{time.strftime("%H:%M:%S")} {FilePath}: {type(err).__name__}: {err}')
+        return
+    Tracks = [Name for Kind, Name in Changed if Kind == 'Track']
+    Lines = [Name for Kind, Name in Changed if Kind == 'Line']
+    print(f'{time.strftime("%H:%M:%S")} {os.path.basename(FilePath)}: re-parsed {len(Tracks)} track(s) {Tracks} '
+          f'and {len(Lines)} line(s) {Lines}' + (f', {len(Removed)} block(s) removed' if Removed else '')
+          + f', saved {", ".join(OutPaths)} in {time.perf_counter() - tic:.2f} s')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Regenerate the tracking output of .kva files whenever they are saved.')
+    parser.add_argument('paths', nargs='+', help='.kva files, directories (searched recursively) or glob patterns')
+    parser.add_argument('--config', help='JSON file with the answers to the interactive prompts')
+    parser.add_argument('--interval', type=float, default=1., help='seconds between checks for saved files')
+    args = parser.parse_args(argv)
+    print(f'Watching {", ".join(args.paths)}, Ctrl+C to stop')
+    try:
+        watch(args.paths, args.config, args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())